@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+"""Versioned, delta-compressed store of config snapshots.
+
+One store per router. Every snapshot that differs from the previous one
+becomes the next version number. Content is deduplicated by hash, and most
+versions are kept as a line delta against the version before them, zlib
+compressed and appended to pack files. A full copy is kept every KEYFRAME
+versions so rebuilding any version never replays more than that many deltas.
+
+Layout:
+  index         append-only fixed-size records, one per version; version N
+                lives at offset (N-1)*RECORD.size, so finding it is O(1)
+  pack-NNNNNN   append-only compressed blobs
+  latest        plain copy of the newest config, for disaster recovery
+
+Commits are atomic and cost the same however many versions there are: the
+blob is appended and synced first, then its index record. A crash leaves at
+worst some unreferenced bytes at the end of a pack, or part of a record at
+the end of the index. Readers ignore such a partial record, as they do one
+still being written; the writer's next commit overwrites it.
+
+A store has one writer at a time: two would delta against versions the
+other doesn't know about. Don't import while the daemon archives into the
+same store.
+
+  ./archive.py Logs/EdgeRouterScraper log
+  ./archive.py Logs/EdgeRouterScraper show 42
+  ./archive.py Logs/EdgeRouterScraper show @2025-06-01T12:00
+  ./archive.py Logs/EdgeRouterScraper import Logs/EdgeRouterScraper/20*/*
+"""
+
+import argparse
+import bisect
+import datetime
+import difflib
+import hashlib
+import json
+import math
+import os
+import struct
+import sys
+import time
+import zlib
+
+
+class Error(Exception):
+  """Do not raise. Package level exception."""
+
+
+class UnknownVersionError(Error):
+  """No such version in the store."""
+
+
+class OutOfOrderError(Error):
+  """A commit timestamp older than the newest version's."""
+
+
+# kinds of index records
+FULL, DELTA, SAME = range(3)
+
+# timestamp, sha1 of the content, kind, base version (DELTA) or original
+# version (SAME), pack number, offset and length of the blob.
+RECORD = struct.Struct('<d20sB3xIIQI')
+
+KEYFRAME = 64  # versions between full copies
+PACK_LIMIT = 16 * 1024 * 1024  # start a new pack beyond this size
+
+
+def digest(text):
+  """Content hash used for deduplication (raw sha1 bytes)."""
+  return hashlib.sha1(text.encode('utf-8')).digest()
+
+
+def _delta(old, new):
+  """Encode new as copy/insert operations against old (lists of lines)."""
+  ops = []
+  matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+  for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+    if tag == 'equal':
+      ops.append(['c', i1, i2])
+    elif j2 > j1:  # replace or insert; deletes need no op at all
+      ops.append(['i', new[j1:j2]])
+  return ops
+
+
+def _patch(old, ops):
+  """Inverse of _delta()."""
+  new = []
+  for op in ops:
+    if op[0] == 'c':
+      new.extend(old[op[1]:op[2]])
+    else:
+      new.extend(op[1])
+  return new
+
+
+class Store(object):
+  """Versioned config snapshots in one directory."""
+
+  def __init__(self, directory):
+    self._dir = directory
+    os.makedirs(directory, exist_ok=True)
+    self._records = []
+    self._timestamps = []
+    self._byTimestamp = {}
+    self._byDigest = {}
+    try:
+      with open(self._path('index'), 'rb') as fh:
+        data = fh.read()
+    except FileNotFoundError:
+      data = b''
+    # a partial record at the end is torn or still being written; commit()
+    # overwrites it.
+    for offset in range(0, len(data) - len(data) % RECORD.size, RECORD.size):
+      self._remember(RECORD.unpack_from(data, offset))
+
+  def _path(self, name):
+    return os.path.join(self._dir, name)
+
+  def _remember(self, record):
+    self._records.append(record)
+    version = len(self._records)
+    self._timestamps.append(record[0])
+    self._byTimestamp[record[0]] = version
+    self._byDigest.setdefault(record[1], version)
+
+  @property
+  def version(self):
+    """Newest version number; 0 while the store is empty."""
+    return len(self._records)
+
+  def __len__(self):
+    return len(self._records)
+
+  def _record(self, version):
+    if not 1 <= version <= len(self._records):
+      raise UnknownVersionError(version)
+    return self._records[version - 1]
+
+  def timestamp(self, version):
+    """When version was committed (seconds since the epoch)."""
+    return self._record(version)[0]
+
+  def sha1(self, version):
+    """Hex content hash of version."""
+    return self._record(version)[1].hex()
+
+  def at(self, timestamp):
+    """Version current at timestamp; exact commit times are O(1)."""
+    version = self._byTimestamp.get(timestamp)
+    if version is not None:
+      return version
+    i = bisect.bisect_right(self._timestamps, timestamp)
+    if i == 0:
+      raise UnknownVersionError('nothing before %s' % timestamp)
+    return i
+
+  def versions(self):
+    """Yield (version, timestamp) oldest first."""
+    for version, record in enumerate(self._records, 1):
+      yield version, record[0]
+
+  def _blob(self, record):
+    unused_ts, unused_sha, unused_kind, unused_ref, pack, offset, length = record
+    with open(self._path('pack-%06d' % pack), 'rb') as fh:
+      fh.seek(offset)
+      return json.loads(zlib.decompress(fh.read(length)).decode('utf-8'))
+
+  def _chain(self, version):
+    """Records needed to rebuild version: a FULL one, then DELTAs in order."""
+    chain = []
+    while True:
+      record = self._record(version)
+      if record[2] == FULL:
+        chain.append(record)
+        chain.reverse()
+        return chain
+      if record[2] == DELTA:
+        chain.append(record)
+      version = record[3]
+
+  def _lines(self, version):
+    """Content of version as a list of lines."""
+    chain = self._chain(version)
+    lines = self._blob(chain[0])
+    for record in chain[1:]:
+      lines = _patch(lines, self._blob(record))
+    return lines
+
+  def get(self, version):
+    """Content of version (str)."""
+    return '\n'.join(self._lines(version))
+
+  def _append(self, blob):
+    """Append blob to the current pack; returns (pack, offset)."""
+    pack = self._records[-1][4] if self._records else 0
+    fn = self._path('pack-%06d' % pack)
+    try:
+      size = os.path.getsize(fn)
+    except FileNotFoundError:
+      size = 0
+    if size > PACK_LIMIT:
+      pack += 1
+      fn = self._path('pack-%06d' % pack)
+      size = 0
+    with open(fn, 'ab') as fh:
+      offset = fh.tell()
+      fh.write(blob)
+      fh.flush()
+      os.fsync(fh.fileno())
+    return pack, offset
+
+  def _replace(self, name, data):
+    """Atomically replace file name with data (bytes)."""
+    tmp = self._path('.%s.tmp' % name)
+    with open(tmp, 'wb') as fh:
+      fh.write(data)
+      fh.flush()
+      os.fsync(fh.fileno())
+    os.replace(tmp, self._path(name))
+
+  def commit(self, text, timestamp=None):
+    """Store text as the next version unless it matches the newest one.
+
+    timestamp defaults to now, or the newest version's if the clock has
+    gone back since; an explicit one older than that raises
+    OutOfOrderError. Returns the version number holding text.
+    """
+    newest = self._timestamps[-1] if self._timestamps else -math.inf
+    if timestamp is None:
+      timestamp = max(time.time(), newest)
+    elif timestamp < newest:
+      raise OutOfOrderError('version %d is newer than %s' % (self.version, timestamp))
+    sha = digest(text)
+    if self._records and self._records[-1][1] == sha:
+      return self.version
+    version = self.version + 1
+    pack, offset, length, ref = 0, 0, 0, 0
+    if sha in self._byDigest:
+      kind, ref = SAME, self._byDigest[sha]
+      if self._records:
+        pack = self._records[-1][4]
+    else:
+      lines = text.split('\n')
+      if not self._records or len(self._chain(self.version)) >= KEYFRAME:
+        kind, payload = FULL, lines
+      else:
+        kind, ref = DELTA, self.version
+        payload = _delta(self._lines(ref), lines)
+      blob = zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'), 9)
+      pack, offset = self._append(blob)
+      length = len(blob)
+    record = (timestamp, sha, kind, ref, pack, offset, length)
+    with open(self._path('index'), 'ab') as fh:
+      fh.truncate(len(self._records) * RECORD.size)  # a torn record from before
+      fh.write(RECORD.pack(*record))
+      fh.flush()
+      os.fsync(fh.fileno())
+    self._remember(record)
+    self._replace('latest', text.encode('utf-8'))
+    return version
+
+
+def _parseWhen(s):
+  """'42' is a version, '@2025-06-01T12:00' a point in time."""
+  if s.startswith('@'):
+    return datetime.datetime.fromisoformat(s[1:]).timestamp()
+  return None
+
+
+def snapshotTime(fn):
+  """Commit time of a Logs/YYYY/YYYYmmdd-HHMMSS file; its mtime otherwise."""
+  try:
+    return datetime.datetime.strptime(os.path.basename(fn), '%Y%m%d-%H%M%S').timestamp()
+  except ValueError:
+    return os.path.getmtime(fn)
+
+
+def main(argv):
+  """Main."""
+  parser = argparse.ArgumentParser(description='Versioned config archive')
+  parser.add_argument('store', help='store directory, e.g. Logs/EdgeRouterScraper')
+  sub = parser.add_subparsers(dest='command', required=True)
+  sub.add_parser('log', help='list versions')
+  p = sub.add_parser('show', help='print one version')
+  p.add_argument('version', help='version number, or @ISO-timestamp')
+  p = sub.add_parser('import', help='add plain snapshot files, oldest first; not while the daemon runs')
+  p.add_argument('files', nargs='+')
+  args = parser.parse_args(argv[1:])
+
+  store = Store(args.store)
+  if args.command == 'log':
+    for version, ts in store.versions():
+      print('%6d  %s  %s' % (version, datetime.datetime.fromtimestamp(ts).isoformat(' ', 'seconds'),
+                             store.sha1(version)))
+  elif args.command == 'show':
+    when = _parseWhen(args.version)
+    version = store.at(when) if when is not None else int(args.version)
+    print(store.get(version))
+  elif args.command == 'import':
+    for fn in sorted(args.files, key=snapshotTime):
+      if os.path.islink(fn) or not os.path.isfile(fn):
+        continue
+      with open(fn, 'r') as fh:
+        version = store.commit(fh.read(), timestamp=snapshotTime(fn))
+      print('%6d  %s' % (version, fn))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,437 @@
+#!/usr/bin/python3
+"""Micro benchmarks for the scraper's hot paths.
+
+  ./bench.py ssh --ip EdgeRouterScraper
+      per-cycle latency of one fork-per-command ssh vs a multiplexed session.
+  ./bench.py parse
+      wlbGetStatus parse time over synthetic outputs of 1 to 1000 groups.
+  ./bench.py diff
+      configdiff of two synthetic configs that differ in one firewall rule.
+  ./bench.py scale
+      configdiff parse and diff time per rule/group member, up to 50k of each.
+  ./bench.py memory [--store Logs/EdgeRouterScraper] [--intern]
+      bytes per line of parsed configs and load-balance statuses held in
+      memory, from 10k archived (or synthetic) snapshots; --intern shares
+      subtrees across them with a configdiff.Interner.
+  ./bench.py lex [FILE...]
+      configdiff.Parser throughput in MB/s from str, bytes, file and mmap,
+      and of loading the same tree from the parse cache.
+  ./bench.py cycle [--routers 1 10 100 500] [--recording Recordings/EdgeRouterScraper]
+      daemon.Engine poll cycles, status and config, against that many
+      fakerouter.FakeRouters: cycle latency, and parse, archive and metric
+      publish cost. No router needed.
+"""
+
+import argparse
+import asyncio
+import logging
+import mmap
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import prometheus_client
+
+import archive
+import configdiff
+import daemon
+import fakerouter
+import flowring
+import poll
+
+
+def _report(name, samples):
+  """Print min/median/p95/max of samples, in milliseconds."""
+  samples = sorted(samples)
+  p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+  print('%-12s n=%-4d min=%8.1fms median=%8.1fms p95=%8.1fms max=%8.1fms' % (
+      name, len(samples), samples[0] * 1000, statistics.median(samples) * 1000,
+      p95 * 1000, samples[-1] * 1000))
+
+
+def benchSsh(args):
+  """Time one poll cycle per connection mode against a real sshd."""
+  cmd = args.command.split()
+  for name, conn in (('fork', poll.SshConnection(args.ip)),
+                     ('multiplexed', poll.MultiplexedSshConnection(args.ip))):
+    conn.Run(cmd)  # warm up; starts the control master when multiplexed.
+    samples = []
+    for _ in range(args.cycles):
+      start = time.perf_counter()
+      out, err = conn.Run(cmd)
+      samples.append(time.perf_counter() - start)
+      if not out:
+        print('%s: no output; stderr=%r' % (name, err), file=sys.stderr)
+    conn.Close()
+    _report(name, samples)
+
+
+def syntheticStatus(groups, interfaces=2, polls=0):
+  """Returns wlbGetStatus-like output (bytes) with the given shape, after
+  polls polls' worth of WAN flows.
+  """
+  out = []
+  for g in range(groups):
+    out.extend([
+        'Group G%d' % g,
+        '    Balance Local  : false',
+        '    Lock Local DNS : false',
+        '    Conntrack Flush: false',
+        '    Sticky Bits    : 0x00000000',
+        ''])
+    for i in range(interfaces):
+      out.extend([
+          '  interface   : eth%d' % i,
+          '  reachable   : true',
+          '  status      : active',
+          '  gateway     : 10.%d.%d.1' % (g % 256, i),
+          '  route table : %d' % (i + 1),
+          '  weight      : %d%%' % (100 // interfaces),
+          '  fo_priority : 60',
+          '  flows',
+          '      WAN Out   : %d' % (g * 7 + i + polls * 40),
+          '      WAN In    : %d' % (g * 3 + i + polls * 30),
+          '      Local ICMP: 2134',
+          '      Local DNS : 0',
+          '      Local Data: 0',
+          ''])
+  return '\n'.join(out).encode('utf-8')
+
+
+def benchParse(args):
+  """Time ShowLoadBalanceStatus.Parse over growing synthetic outputs."""
+  for groups in (1, 10, 100, 1000):
+    out = syntheticStatus(groups)
+    nlines = out.count(b'\n') + 1
+    samples = []
+    for _ in range(args.repeat):
+      start = time.perf_counter()
+      poll.ShowLoadBalanceStatus(None).Parse(out)
+      samples.append(time.perf_counter() - start)
+    best = min(samples)
+    print('groups=%-5d lines=%-6d best=%9.3fms  %6.0fns/line' % (
+        groups, nlines, best * 1000, best / nlines * 1e9))
+
+
+def syntheticConfig(rules, members=0, changed=None):
+  """Returns config.boot-like text with the given number of firewall rules
+  and address-group and network-group members. Rule number changed gets a
+  different action.
+  """
+  out = ['firewall {', '    all-ping enable', '    group {', '        address-group LAN {']
+  for m in range(members):
+    out.append('            address 10.%d.%d.%d' % (m >> 16 & 255, m >> 8 & 255, m & 255))
+  out.extend(['        }', '        network-group NETS {'])
+  for m in range(members):
+    out.append('            network 172.%d.%d.0/24' % (16 + (m >> 8 & 15), m & 255 if m < 4096 else m % 251))
+  out.extend(['        }', '    }', '    name WAN_IN {', '        default-action drop'])
+  for r in range(rules):
+    out.extend([
+        '        rule %d {' % (r + 1),
+        '            action %s' % ('drop' if r + 1 == changed else 'accept'),
+        '            destination {',
+        '                port %d' % (1024 + r % 60000),
+        '            }',
+        '            protocol tcp',
+        '        }'])
+  out.extend(['    }', '}', 'system {', '    host-name ubnt', '}', '',
+              '/* Warning: Do not remove the following line. */'])
+  return '\n'.join(out) + '\n'
+
+
+def benchDiff(args):
+  """Time Config.udiff of configs differing in one rule, over growing sizes."""
+  for rules in (100, 1000, 10000):
+    lhs = configdiff.parse(syntheticConfig(rules))
+    rhs = configdiff.parse(syntheticConfig(rules, changed=rules // 2))
+    nlines = str(lhs).count('\n')
+    start = time.perf_counter()
+    lhs.digest, rhs.digest  # computed once per tree, then cached
+    print('rules=%-6d lines=%-7d %-8s      %9.3fms' % (
+        rules, nlines, 'digest', (time.perf_counter() - start) * 1000))
+    for name, context in (('full', None), ('-U3', 3), ('-U0', 0)):
+      samples = []
+      for _ in range(args.repeat):
+        start = time.perf_counter()
+        out = sum(1 for _ in lhs.udiff(rhs, context))
+        samples.append(time.perf_counter() - start)
+      print('rules=%-6d lines=%-7d %-8s best=%9.3fms  %d lines out' % (
+          rules, nlines, name, min(samples) * 1000, out))
+
+
+def benchScale(args):
+  """Time configdiff parse and diff per item (a rule or a group member) as
+  rules and members grow.
+
+  Flat per-item times mean linear scaling.
+  """
+  for n in (5000, 10000, 25000, 50000):
+    lhs_text = syntheticConfig(n, members=n)
+    rhs_text = syntheticConfig(n, members=n, changed=n // 2)
+    start = time.perf_counter()
+    lhs = configdiff.parse(lhs_text)
+    rhs = configdiff.parse(rhs_text)
+    parsed = time.perf_counter()
+    for _ in lhs.udiff(rhs):
+      pass
+    diffed = time.perf_counter()
+    print('rules=members=%-6d parse=%8.1fms (%5.1fus/item)  diff=%8.1fms (%5.1fus/item)' % (
+        n, (parsed - start) * 1000, (parsed - start) / (6 * n) * 1e6,
+        (diffed - parsed) * 1000, (diffed - parsed) / (3 * n) * 1e6))
+
+
+def _mmap(fn):
+  """Returns file fn mapped read-only."""
+  with open(fn, 'rb') as fh:
+    return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def benchLex(args):
+  """Parse throughput of configdiff.Parser per kind of input, in MB/s."""
+  if args.files:
+    fns = args.files
+  else:
+    fh = tempfile.NamedTemporaryFile('w', suffix='.boot', delete=False)
+    fh.write(syntheticConfig(10000, members=10000))
+    fh.close()
+    fns = [fh.name]
+  try:
+    for fn in fns:
+      with open(fn, 'rb') as fh:
+        data = fh.read()
+      sources = (
+          ('str', lambda: data.decode('utf-8')),
+          ('bytes', lambda: data),
+          ('file', lambda: open(fn, 'rb')),
+          ('mmap', lambda: _mmap(fn)),
+      )
+      for name, source in sources:
+        samples = []
+        for _ in range(args.repeat):
+          src = source()
+          start = time.perf_counter()
+          configdiff.parse(src)
+          samples.append(time.perf_counter() - start)
+          if hasattr(src, 'close'):
+            src.close()
+        best = min(samples)
+        print('%-6s %8d bytes  best=%8.1fms  %6.2f MB/s' % (
+            name, len(data), best * 1000, len(data) / best / 1e6))
+      # what a configdiff.ParseCache hit costs instead.
+      frozen = configdiff.dumps(configdiff.parse(data))
+      samples = []
+      for _ in range(args.repeat):
+        start = time.perf_counter()
+        configdiff.loads(frozen)
+        samples.append(time.perf_counter() - start)
+      best = min(samples)
+      print('%-6s %8d bytes  best=%8.1fms  %6.2f MB/s' % (
+          'cached', len(data), best * 1000, len(data) / best / 1e6))
+  finally:
+    if not args.files:
+      os.unlink(fns[0])
+
+
+def _snapshotTexts(args):
+  """Yield args.snapshots config texts from args.store, or synthetic ones
+  that each differ from the last in one rule.
+  """
+  if args.store:
+    store = archive.Store(args.store)
+    for version in range(1, min(store.version, args.snapshots) + 1):
+      yield store.get(version)
+    return
+  for i in range(args.snapshots):
+    yield syntheticConfig(args.rules, members=args.members, changed=i % args.rules + 1)
+
+
+def benchMemory(args):
+  """Traced bytes per line of parsed configs and statuses kept alive."""
+  configs = []
+  lines = 0
+  interner = configdiff.Interner() if args.intern else None
+  start = time.perf_counter()
+  tracemalloc.start()
+  for text in _snapshotTexts(args):
+    configs.append(configdiff.parse(text, interner))
+    lines += text.count('\n')
+  size = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  print('configs=%-6d lines=%-8d %8.1fMB  %6.1f bytes/line  %6.1fs' % (
+      len(configs), lines, size / 1e6, size / max(lines, 1), time.perf_counter() - start))
+  if len(configs) > 1:
+    start = time.perf_counter()
+    for lhs, rhs in zip(configs, configs[1:]):
+      for _ in lhs.udiff(rhs, 3):
+        pass
+    print('diffed %d consecutive pairs in %.1fs' % (len(configs) - 1, time.perf_counter() - start))
+  del configs, interner
+
+  out = syntheticStatus(args.groups)
+  nlines = out.count(b'\n') + 1
+  statuses = []
+  tracemalloc.start()
+  for _ in range(args.statuses):
+    lb = poll.ShowLoadBalanceStatus(None)
+    lb.Parse(out)
+    statuses.append(lb)
+  size = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  print('statuses=%-5d lines=%-8d %8.1fMB  %6.1f bytes/line' % (
+      len(statuses), nlines * len(statuses), size / 1e6, size / (nlines * len(statuses))))
+
+
+def _sampleSum(name, stages):
+  """Sum of histogram name's _sum over every router, for the given stages."""
+  total = 0
+  for metric in prometheus_client.REGISTRY.collect():
+    for sample in metric.samples:
+      if sample.name == name + '_sum' and sample.labels.get('stage') in stages:
+        total += sample.value
+  return total
+
+
+async def _round(engine, routers, parallel):
+  """Poll every router once, status and config, parallel at a time.
+
+  Returns (per-cycle seconds of those that worked, number that failed).
+  """
+  slots = asyncio.Semaphore(parallel)
+  samples = []
+
+  async def one(router):
+    async with slots:
+      start = time.perf_counter()
+      try:
+        await engine.cycle(router, config=True)
+      except Exception:  # a fault the fake was asked for, e.g. a timeout
+        return 1
+      samples.append(time.perf_counter() - start)
+      return 0
+
+  failed = await asyncio.gather(*(one(router) for router in routers))
+  return samples, sum(failed)
+
+
+async def _rounds(engine, routers, args):
+  """Runs a warm-up round, which archives version 1, then args.rounds timed
+  ones, each followed by a scrape.
+
+  Returns (cycle seconds, round seconds, scrape seconds, failed cycles,
+  parse seconds, archive seconds).
+  """
+  await _round(engine, routers, args.parallel)
+  parse = -_sampleSum('poll_parse_seconds', ('status', 'config'))
+  archived = -_sampleSum('archive_seconds', ('write', 'configdiff'))
+  cycles, walls, scrapes, failed = [], [], [], 0
+  for _ in range(args.rounds):
+    start = time.perf_counter()
+    samples, f = await _round(engine, routers, args.parallel)
+    walls.append(time.perf_counter() - start)
+    cycles.extend(samples)
+    failed += f
+    start = time.perf_counter()
+    prometheus_client.generate_latest()
+    scrapes.append(time.perf_counter() - start)
+  parse += _sampleSum('poll_parse_seconds', ('status', 'config'))
+  archived += _sampleSum('archive_seconds', ('write', 'configdiff'))
+  return cycles, walls, scrapes, failed, parse, archived
+
+
+def benchCycle(args):
+  """Time full daemon poll cycles against fake routers, as many as asked.
+
+  Each round polls every router once with Engine.cycle(), config included;
+  the recording's config versions rotate, so each round archives one per
+  router. Parse and archive cost come from the daemon's own histograms,
+  publish cost is rendering one scrape of every router's metrics.
+  """
+  logging.disable(logging.ERROR)  # the faults asked for are counted instead
+  with tempfile.TemporaryDirectory() as tmp:
+    if args.recording:
+      recording = fakerouter.Recording(args.recording)
+    else:
+      recording = fakerouter.Recording.write(
+          os.path.join(tmp, 'recording'),
+          [syntheticStatus(args.groups, polls=i) for i in range(args.rounds + 1)],
+          [syntheticConfig(args.rules, changed=i + 1).encode('utf-8') for i in range(args.rounds + 1)])
+    for n in sorted(args.routers):
+      routers = ['r%d' % i for i in range(n)]
+      conns = {router: fakerouter.FakeRouter(recording, latency=args.latency, hang=args.hang,
+                                             truncate=args.truncate, fail=args.fail, seed=i)
+               for i, router in enumerate(routers)}
+      engine = daemon.Engine(conns, os.path.join(tmp, 'logs-%d' % n), timeout=args.timeout,
+                             jitter=0, flows=flowring.FlowHistory())
+      cycles, walls, scrapes, failed, parse, archived = asyncio.run(_rounds(engine, routers, args))
+      print('routers=%-4d failed=%d/%d' % (n, failed, n * args.rounds))
+      if cycles:
+        _report('cycle', cycles)
+      _report('round', walls)
+      _report('publish', scrapes)
+      polls = max(1, n * args.rounds - failed)
+      print('%-12s parse=%8.3fms archive=%8.3fms per cycle' % (
+          '', parse / polls * 1000, archived / polls * 1000))
+
+
+def main(argv):
+  """Main."""
+  parser = argparse.ArgumentParser(description='Scraper benchmarks')
+  sub = parser.add_subparsers(dest='bench', required=True)
+
+  p = sub.add_parser('ssh', help='fork-per-command vs multiplexed ssh')
+  p.add_argument('--ip', default='EdgeRouterScraper', help='ssh destination; default=EdgeRouterScraper')
+  p.add_argument('--cycles', type=int, default=20, help='poll cycles per mode')
+  p.add_argument('--command', default='/usr/sbin/ubnt-hal wlbGetStatus',
+                 help='remote command; use e.g. "echo" against a plain sshd')
+  p.set_defaults(func=benchSsh)
+
+  p = sub.add_parser('parse', help='wlbGetStatus parser')
+  p.add_argument('--repeat', type=int, default=20, help='runs per size; best is reported')
+  p.set_defaults(func=benchParse)
+
+  p = sub.add_parser('diff', help='configdiff of configs that differ in one rule')
+  p.add_argument('--repeat', type=int, default=5, help='runs per size; best is reported')
+  p.set_defaults(func=benchDiff)
+
+  p = sub.add_parser('memory', help='memory held by parsed configs and statuses')
+  p.add_argument('--store', help='archive.Store to load versions from; default is synthetic configs')
+  p.add_argument('--snapshots', type=int, default=10000, help='configs to load')
+  p.add_argument('--rules', type=int, default=10, help='firewall rules per synthetic config')
+  p.add_argument('--members', type=int, default=10, help='group members per synthetic config')
+  p.add_argument('--statuses', type=int, default=1000, help='wlbGetStatus outputs to parse')
+  p.add_argument('--groups', type=int, default=10, help='load-balance groups per status')
+  p.add_argument('--intern', action='store_true', help='share config subtrees with a configdiff.Interner')
+  p.set_defaults(func=benchMemory)
+
+  p = sub.add_parser('lex', help='configdiff parse throughput')
+  p.add_argument('--repeat', type=int, default=5, help='runs per input; best is reported')
+  p.add_argument('files', nargs='*', help='configs to parse; default is a synthetic 10k-rule one')
+  p.set_defaults(func=benchLex)
+
+  p = sub.add_parser('scale', help='configdiff with up to 50k rules and group members')
+  p.set_defaults(func=benchScale)
+
+  p = sub.add_parser('cycle', help='daemon poll cycles against fake routers')
+  p.add_argument('--routers', type=int, nargs='+', default=[1, 10, 100, 500],
+                 help='simulated router counts; default=1 10 100 500')
+  p.add_argument('--rounds', type=int, default=5, help='polls of every router per count')
+  p.add_argument('--parallel', type=int, default=100, help='most cycles in flight at once')
+  p.add_argument('--recording', help='fakerouter.py recording to replay; default is synthetic')
+  p.add_argument('--groups', type=int, default=2, help='load-balance groups per synthetic status')
+  p.add_argument('--rules', type=int, default=100, help='firewall rules per synthetic config')
+  p.add_argument('--timeout', type=float, default=10, help='seconds per cycle, as daemon.py --timeout')
+  p.add_argument('--latency', type=float, default=0, help='fake connect latency in seconds')
+  p.add_argument('--hang', type=float, default=0, help='probability a status command hangs')
+  p.add_argument('--truncate', type=float, default=0, help='probability a session is cut off')
+  p.add_argument('--fail', type=float, default=0, help='probability a status command fails')
+  p.set_defaults(func=benchCycle)
+
+  args = parser.parse_args(argv[1:])
+  args.func(args)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -1,8 +1,26 @@
 #!/usr/bin/python3
 """Parse and produce a unified diff from two EdgeRouter config files."""
 
+import argparse
+import collections
+import gc
+import glob
+import hashlib
+import itertools
+import marshal
+import mmap
+import multiprocessing
+import os
 import re
 import sys
+import tempfile
+
+import archive
+
+
+# Bump whenever parsing or the tree changes; cached trees of other versions
+# are discarded.
+PARSER_VERSION = 2
 
 
 class Error(Exception):
@@ -17,13 +35,177 @@ class UnknownKeyError(Error):
   """Key could not be found."""
 
 
-class Entry:
+class ParseError(Error):
+  """Malformed config; lineno is the 1-based line number."""
+
+  def __init__(self, message, lineno):
+    super().__init__(message)
+    self.lineno = lineno
+
+
+def _hash(*parts):
+  """Digest of parts: str, None, or the digests of child nodes."""
+  return hashlib.sha1(b'\0'.join(
+      b'\1' if part is None else part if isinstance(part, bytes) else part.encode('utf-8')
+      for part in parts)).digest()
+
+
+# Indentation of each nesting level of config.boot.
+INDENT = '    '
+
+
+class _Node:
+  """Structural digest shared by the config tree classes.
+
+  Every node caches a hash of its content, indentation aside. Equal digests
+  mean equal subtrees, so comparing and diffing can skip them in O(1).
+  Nodes don't know their parents: a tree is built first, then hashed, and
+  a node whose digest has been taken can no longer change.
+
+  Nodes use __slots__ and know their nesting depth rather than their
+  indent string; many parsed configs are kept in memory at once.
+  """
+
+  __slots__ = ('_digest',)
+
+  @property
+  def digest(self):
+    """Structural hash of this subtree (bytes)."""
+    if self._digest is None:
+      self._digest = self._computeDigest()
+    return self._digest
+
+  def _invalidate(self):
+    if self._digest is not None:
+      raise ProgrammerError('%s changed after it was hashed' % type(self).__name__)
+
+  def __eq__(self, rhs):
+    if self is rhs:  # shared by an Interner
+      return True
+    if type(self) is type(rhs):
+      return self.digest == rhs.digest
+    return str(self) == str(rhs)
+
+  def __hash__(self):
+    return hash(self.digest)
+
+  def udiff(self, rhs, context=None):
+    """Yield the lines of a unified-diff like comparison with rhs.
+
+    context=None yields every line. Otherwise only changed lines, the braces
+    of the sections holding them and up to context unchanged lines next to
+    a change are kept; each run of unchanged lines left out becomes one
+    "...".
+    """
+    return _collapse(self._udiff(rhs), context)
+
+
+# Kinds of items in the _udiff() stream. _SAME and _TREE are unchanged
+# (a line; a whole identical subtree, rendered only if needed), _CHANGE is a
+# -/+ line and _BRACE opens or closes a section that holds changes.
+_SAME, _TREE, _CHANGE, _BRACE = range(4)
+
+
+def _marker(item):
+  """The "..." standing in for unchanged lines from item on, indented like it."""
+  if isinstance(item, str):
+    return item[:len(item) - len(item[1:].lstrip(' '))] + '...'
+  return item[1] + '...'
+
+
+def _minLines(item):
+  """Fewest lines item (a line or a (node, prefix) subtree) renders to."""
+  if isinstance(item, str):
+    return 1
+  return 2 if isinstance(item[0], Section) else 1
+
+
+def _tail(pending, n):
+  """Returns the last n lines of pending items, and whether any were cut."""
+  lines = []
+  for item in reversed(pending):
+    if len(lines) == n:
+      return lines[::-1], True
+    if isinstance(item, str):
+      lines.append(item)
+      continue
+    got = list(itertools.islice(item[0]._sameReversed(item[1]), n - len(lines) + 1))
+    if len(lines) + len(got) > n:
+      lines.extend(got[:n - len(lines)])
+      return lines[::-1], True
+    lines.extend(got)
+  return lines[::-1], False
+
+
+def _collapse(stream, context):
+  """Render a _udiff() stream into lines, see _Node.udiff.
+
+  Unchanged subtrees are only rendered as far as they are shown, so time
+  and memory follow the size of the output.
+  """
+  if context is None:
+    for kind, item in stream:
+      if kind == _TREE:
+        yield from item[0]._same(item[1])
+      else:
+        yield item
+    return
+  pending = collections.deque()  # unchanged lines and subtrees not shown yet
+  skipped = None  # marker for unchanged lines dropped since the last shown one
+  after = 0  # unchanged lines still to show after the last change
+  for kind, item in stream:
+    if kind == _CHANGE:
+      lines, cut = _tail(pending, context)
+      if cut:
+        skipped = skipped or _marker(pending[0])
+      if skipped:
+        yield skipped
+        skipped = None
+      yield from lines
+      pending.clear()
+      yield item
+      after = context
+    elif kind == _BRACE:  # always shown; unchanged lines before it are not
+      if pending:
+        skipped = skipped or _marker(pending[0])
+        pending.clear()
+      if skipped:
+        yield skipped
+        skipped = None
+      yield item
+    elif after and kind == _SAME:
+      yield item
+      after -= 1
+    elif after:  # _TREE: its head closes the window, the rest is pending
+      head = list(itertools.islice(item[0]._same(item[1]), after + context + 1))
+      yield from head[:after]
+      if len(head) <= after + context:
+        pending.extend(head[after:])
+      else:  # too long to show whole; only its tail can still be context
+        skipped = skipped or _marker(head[after])
+        pending.append(item)
+      after = max(0, after - len(head))
+    else:
+      pending.append(item)
+      # drop what newer pending items are sure to push out of the window
+      while len(pending) > 1 and sum(_minLines(i) for i in itertools.islice(pending, 1, None)) >= context:
+        dropped = pending.popleft()
+        skipped = skipped or _marker(dropped)
+  if pending:
+    skipped = skipped or _marker(pending[0])
+  if skipped:
+    yield skipped
+
+
+class Entry(_Node):
   """Entry key,value pairs, such as "address 1.2.3.4/24"."""
 
-  def __init__(self, parent, key, value):
+  __slots__ = ('_key', '_value')
+
+  def __init__(self, key, value):
+    self._digest = None
     self._key = key
     self._value = value
-    self._parent = parent
 
   @property
   def name(self):
@@ -46,6 +228,9 @@ class Entry:
     # return '""'
     # not needed for just diff'ing, only for edits to the config
 
+  def _computeDigest(self):
+    return _hash(self._key, self._value)
+
   def toString(self, prefix=None):
     """User readable string. prepend "prefix=" to every line."""
     if prefix is None:
@@ -64,56 +249,87 @@ class Entry:
     return str(self) < str(rhs)
 
   def __eq__(self, rhs):
+    if type(rhs) is Entry:  # cheaper than hashing both
+      return self._key == rhs._key and self._value == rhs._value
     return str(self) == str(rhs)
 
+  def __hash__(self):
+    return hash((self._key, self._value))
 
-class Entries:
+
+class Entries(_Node):
   """Aggregate multiple Entry objects."""
 
   # DO NOT SORT these entries. order matters i.e. set interfaces ethernet eth0 address a.b.c.d/24
   unsorted_entries = ('address',)
 
-  def __init__(self, parent, indent, entry):
-    self._parent = parent
-    self._indent = indent  # TODO: this is the indent of the parent.
-    self._entries = [entry]
-    self._name = entry.name
+  __slots__ = ('_depth', '_entries', '_byValue', '_sorted')
+
+  def __init__(self, depth, entry):
+    self._digest = None
+    self._depth = depth  # nesting level of the entries' lines
+    self._entries = [entry]  # as added; see _ordered()
+    self._byValue = None  # first Entry of each value, once there are two
+    self._sorted = True
 
   @property
   def name(self):
     """Return name of these Entries."""
-    return self._name
+    return self._entries[0].key
+
+  @property
+  def _indent(self):
+    return INDENT * self._depth
+
+  def _index(self):
+    """Returns {value: first Entry with that value}."""
+    if self._byValue is None:
+      entry = self._entries[0]
+      return {entry.value: entry}
+    return self._byValue
+
+  def _ordered(self):
+    """Entries in output order, sorting them at most once per change.
+
+    Sortable entries go in descending order of their string (see
+    Entry.__lt__); the sort is stable, so duplicates keep their order.
+    """
+    if not self._sorted:
+      self._entries.sort(key=str, reverse=True)
+      self._sorted = True
+    return self._entries
 
   def keys(self):
     """Return keys to sort the Entries by.
     Since 'key' is identical for all Entry objects, se must use value.
     """
-    retval = []
-    for entry in self._entries:
-      retval.append(entry.value)
-    return retval
+    return [entry.value for entry in self._ordered()]
 
   def sortable(self):
     """Returns True if this self._name is sortable.
     Some keys are order dependent. Don't mess with that.
     """
-    return self._name not in Entries.unsorted_entries
+    return self.name not in Entries.unsorted_entries
 
   def get(self, key):
     """Returns the requested Entry object."""
-    for entry in self._entries:
-      if key == entry.value:
-        return entry
-    raise UnknownKeyError('no suck key %s' % key)
+    try:
+      return self._index()[key]
+    except KeyError:
+      raise UnknownKeyError('no suck key %s' % key) from None
 
   def add(self, entry):
     """Add new Entry to this collection of Entries."""
-    if self._name is None:
-      self._name = entry.name
-    assert entry.name == self._name, '%s != %s' % (entry.name, self._name)
+    assert entry.name == self.name, '%s != %s' % (entry.name, self.name)
+    self._invalidate()
+    self._byValue = self._index()
     self._entries.append(entry)
+    self._byValue.setdefault(entry.value, entry)
     if self.sortable():
-      self._entries.sort()
+      self._sorted = False
+
+  def _computeDigest(self):
+    return _hash(self.name, *self.keys())
 
   def __lt__(self, rhs):
     return str(self) > str(rhs)
@@ -121,48 +337,69 @@ class Entries:
   def __gt__(self, rhs):
     return str(self) < str(rhs)
 
-  def __eq__(self, rhs):
-    return str(self) == str(rhs)
+  def lines(self, prefix=None):
+    """Yield toString() one line at a time."""
+    if prefix is None:
+      prefix = self._indent
+    for entry in self._ordered():
+      yield entry.toString(prefix=prefix)
 
   def toString(self, prefix=None):
     """User readable string. prepend "prefix=" to every line."""
-    if prefix is None:
-      prefix = self._indent
-    retval = []
-    for entry in self._entries:
-      retval.append('%s' % entry.toString(prefix=prefix))
-    return '\n'.join(retval)
+    return '\n'.join(self.lines(prefix))
 
   def __str__(self):
     return self.toString()
 
-  def udiff(self, rhs):
-    """Returns list of strings containing unified-diff like output."""
-    retval = []
-    lhs_keys = self.keys()
-    rhs_keys = rhs.keys()
-    keys = list(set(lhs_keys + rhs_keys))
+  def _keys(self, rhs):
+    """Union of both sides' keys in diff order: sorted, or as they appear."""
+    keys = dict.fromkeys(self.keys())
+    keys.update(dict.fromkeys(rhs.keys()))
     if self.sortable():
-      keys.sort()
-    for key in keys:
-      if key not in rhs_keys:
-        retval.append('%s' % self.get(key).toString(prefix='-%s' % self._indent))
-      elif key not in lhs_keys:
-        retval.append('%s' % rhs.get(key).toString(prefix='+%s' % self._indent))
-      elif self.get(key) == rhs.get(key):
-        retval.append('%s' % self.get(key).toString(prefix=' %s' % self._indent))
+      return sorted(keys)
+    return list(keys)
+
+  def _same(self, prefix):
+    """Yield the unchanged lines udiff() shows for these Entries."""
+    index = self._index()
+    for key in self._keys(self):
+      yield index[key].toString(prefix=prefix)
+
+  def _sameReversed(self, prefix):
+    """_same() backwards."""
+    index = self._index()
+    for key in reversed(self._keys(self)):
+      yield index[key].toString(prefix=prefix)
+
+  def _udiff(self, rhs):
+    """Yield (kind, line) of the diff with rhs, see _collapse()."""
+    if self is rhs or self.digest == rhs.digest:
+      yield _TREE, (self, ' %s' % self._indent)
+      return
+    lhs_entries = self._index()
+    rhs_entries = rhs._index()
+    for key in self._keys(rhs):
+      left = lhs_entries.get(key)
+      right = rhs_entries.get(key)
+      if right is None:
+        yield _CHANGE, left.toString(prefix='-%s' % self._indent)
+      elif left is None:
+        yield _CHANGE, right.toString(prefix='+%s' % self._indent)
+      elif left == right:
+        yield _SAME, left.toString(prefix=' %s' % self._indent)
       else:
         raise ProgrammerError('unexplained key %s' % key)
-    return retval
 
 
-class Section:
+class Section(_Node):
   """Nestable sections."""
 
-  def __init__(self, parent, indent, name):
-    self._indent = indent
+  __slots__ = ('_depth', '_name', '_entries', '_sections')
+
+  def __init__(self, depth, name):
+    self._digest = None
+    self._depth = depth  # nesting level; 0 for top level sections
     self._name = name
-    self._parent = parent
     self._entries = {}
     self._sections = {}
 
@@ -170,40 +407,36 @@ class Section:
     """Add new Entry. For example "address 1.2.3.4/24"."""
     k = entry.key  # standardize on name?
     # duplicates possible e.g. 'network'
+    self._invalidate()
     if k in self._entries:
       self._entries[k].add(entry)
     else:
-      self._entries[k] = Entries(self, self._indent+'    ', entry)
+      self._entries[k] = Entries(self._depth + 1, entry)
 
   def add_section(self, section):
     """Add new section. For example "firewall {...}"."""
     k = section.name
     assert k not in self._sections
+    self._invalidate()
     self._sections[k] = section
 
-  @property
-  def parent(self):
-    """Track who's our parent."""
-    return self._parent
-
-  @parent.setter
-  def parent(self, parent):
-    """Track who's our parent."""
-    self._parent = parent
-
   @property
   def name(self):
     """Returns section name."""
     return self._name
 
+  @property
+  def _indent(self):
+    return INDENT * self._depth
+
   def __lt__(self, rhs):
     return str(self) > str(rhs)
 
   def __gt__(self, rhs):
     return str(self) < str(rhs)
 
-  def __eq__(self, rhs):
-    return str(self) == str(rhs)
+  def _computeDigest(self):
+    return _hash(self._name, *[self.get(k).digest for k in sorted(self.keys())])
 
   def keys(self):
     """Return list of keys for sorting."""
@@ -222,46 +455,80 @@ class Section:
       return self._sections[key]
     raise UnknownKeyError(key)
 
-  def toString(self, prefix=None):
-    """User readable string. prepend "prefix=" to every line."""
+  def lines(self, prefix=None):
+    """Yield toString() one line at a time."""
     if prefix is None:
       prefix = self._indent
-    #print('Section.__str__ %s' % self.name, file=sys.stderr)
-    retval = ['%s%s {' % (prefix, self.name)]
+    yield '%s%s {' % (prefix, self.name)
     for k in sorted(self.keys()):
-      retval.append(self.get(k).toString(prefix=prefix + '    '))
-    retval.append('%s}' % prefix)
-    return '\n'.join(retval)
+      yield from self.get(k).lines(prefix=prefix + '    ')
+    yield '%s}' % prefix
+
+  def toString(self, prefix=None):
+    """User readable string. prepend "prefix=" to every line."""
+    return '\n'.join(self.lines(prefix))
 
   def __str__(self):
     return self.toString()
 
-  def udiff(self, rhs):
-    """Returns list of strings containing unified-diff like output."""
-    retval = []
+  def walk(self, path=()):
+    """Yield (path, Entries) for every entry below this section.
+
+    path is the tuple of section names leading to the entry, ending in the
+    entry key, e.g. ('interfaces', 'ethernet eth2', 'address').
+    """
+    path += (self.name,)
+    for k in self.keys():
+      item = self.get(k)
+      if isinstance(item, Section):
+        yield from item.walk(path)
+      else:
+        yield path + (item.name,), item
+
+  def _same(self, prefix):
+    """Yield the unchanged lines udiff() shows for this section."""
+    yield '%s%s {' % (prefix, self.name)
+    for k in sorted(self.keys()):
+      yield from self.get(k)._same(prefix + '    ')
+    yield '%s}' % prefix
+
+  def _sameReversed(self, prefix):
+    """_same() backwards."""
+    yield '%s}' % prefix
+    for k in sorted(self.keys(), reverse=True):
+      yield from self.get(k)._sameReversed(prefix + '    ')
+    yield '%s%s {' % (prefix, self.name)
+
+  def _udiff(self, rhs):
+    """Yield (kind, line) of the diff with rhs, see _collapse()."""
     # self
     assert self.name == rhs.name, '%s != %s' % (self.name, rhs.name)
-    retval.append(' %s%s {' % (self._indent, self.name))
+    if self is rhs or self.digest == rhs.digest:
+      yield _TREE, (self, ' %s' % self._indent)
+      return
+    yield _BRACE, ' %s%s {' % (self._indent, self.name)
     # contents
-    lhs_keys = self.keys()
-    rhs_keys = rhs.keys()
-    for key in sorted(set(lhs_keys + rhs_keys)):
+    lhs_keys = set(self.keys())
+    rhs_keys = set(rhs.keys())
+    for key in sorted(lhs_keys | rhs_keys):
       if key not in rhs_keys:
-        retval.append('%s' % self.get(key).toString(prefix='-    %s' % self._indent))
+        for line in self.get(key).lines(prefix='-    %s' % self._indent):
+          yield _CHANGE, line
       elif key not in lhs_keys:
-        retval.append('%s' % rhs.get(key).toString(prefix='+    %s' % self._indent))
-      else:  # recurse
-        left = self.get(key)
-        right = rhs.get(key)
-        retval.extend(left.udiff(right))
-    retval.append(' %s}' % self._indent)
-    return retval
+        for line in rhs.get(key).lines(prefix='+    %s' % self._indent):
+          yield _CHANGE, line
+      else:  # recurse; identical subtrees cost O(1), see _Node
+        yield from self.get(key)._udiff(rhs.get(key))
+    yield _BRACE, ' %s}' % self._indent
 
 
-class Config:
+class Config(_Node):
   """Data class for EdgeRouter configuration."""
 
+  __slots__ = ('_header', '_sections', '_footer')
+
   def __init__(self):
+    self._digest = None
     self._header = []
     # presumably only sections, no Entries. if so, change to extend Section?
     self._sections = {}
@@ -271,16 +538,24 @@ class Config:
     """Add new section."""
     k = section.name
     assert k not in self._sections, 'Duplicate found: %s' % k
+    self._invalidate()
     self._sections[k] = section
 
   def add_header(self, line):
     """Add header line before the config."""
+    self._invalidate()
     self._header.append(line)
 
   def add_footer(self, line):
     """Add footer line after the config."""
+    self._invalidate()
     self._footer.append(line)
 
+  def _computeDigest(self):
+    return _hash(_hash(*self._header),
+                 *[self.get(k).digest for k in sorted(self.keys())],
+                 _hash(*self._footer))
+
   def keys(self):
     """Return list of keys for sorting."""
     k = list(self._sections.keys())
@@ -290,6 +565,11 @@ class Config:
     """Raises KeyError if key not present."""
     return self._sections[key]
 
+  def walk(self):
+    """Yield (path, Entries) for every entry in the config; see Section.walk."""
+    for k in self.keys():
+      yield from self.get(k).walk()
+
   def __str__(self):
     return self.toString()
 
@@ -320,80 +600,185 @@ class Config:
   def __gt__(self, rhs):
     return str(self) < str(rhs)
 
-  def __eq__(self, rhs):
-    return str(self) == str(rhs)
-
-  def udiff(self, rhs):
-    """Returns list of strings containing unified-diff like output."""
-    retval = []
-    lhs_keys = self.keys()
-    rhs_keys = rhs.keys()
-    for key in sorted(set(lhs_keys + rhs_keys)):
+  def _udiff(self, rhs):
+    """Yield (kind, line) of the diff of the sections with rhs's, see _collapse()."""
+    lhs_keys = set(self.keys())
+    rhs_keys = set(rhs.keys())
+    for key in sorted(lhs_keys | rhs_keys):
       if key not in rhs_keys:
-        retval.append('%s' % (self.get(key).toString(prefix='-')))
+        for line in self.get(key).lines(prefix='-'):
+          yield _CHANGE, line
       elif key not in lhs_keys:
-        retval.append('%s' % (rhs.get(key).toString(prefix='+')))
+        for line in rhs.get(key).lines(prefix='+'):
+          yield _CHANGE, line
       else:  # recurse
-        left = self.get(key)
-        right = rhs.get(key)
-        retval.extend(left.udiff(right))
-    # TODO: selectively print context (lines with '{', '}') and ...\n
-    return '\n'.join(retval)
+        yield from self.get(key)._udiff(rhs.get(key))
 
 
-class Parser:
-  """Parser for Edgerouter config."""
+class Interner:
+  """Hash-consing of config subtrees across any number of configs.
+
+  Equal Section and Entries subtrees at the same depth, and equal Entry
+  objects anywhere, become one shared object, whichever config they came
+  from. Consecutive snapshots differ in a handful of lines, so keeping many
+  of them costs memory in proportion to what changed, and diffing shared
+  subtrees is an identity check.
+
+  Every distinct subtree seen stays alive as long as the Interner does.
+  Shared nodes are hashed and so can't change, see _Node.
+  """
 
   def __init__(self):
+    self._nodes = {}  # (type, depth, digest) -> node
+    self._entries = {}  # Entry -> itself
+
+  def __len__(self):
+    return len(self._nodes) + len(self._entries)
+
+  def _share(self, node):
+    return self._nodes.setdefault((type(node), node._depth, node.digest), node)
+
+  def section(self, section):
+    """Returns the shared equal of section; its subsections must already
+    be shared, as when sections are interned as the parser closes them.
+    """
+    entries = section._entries
+    for key, collection in entries.items():
+      shared = self._share(collection)
+      if shared is collection:  # new; share its Entry objects instead
+        pool = self._entries
+        items = collection._entries = [pool.setdefault(e, e) for e in collection._entries]
+        if collection._byValue is not None:
+          collection._byValue = {}
+          for entry in items:
+            collection._byValue.setdefault(entry.value, entry)
+      entries[key] = shared
+    return self._share(section)
+
+  def intern(self, config):
+    """Replace config's subtrees with shared ones; returns config."""
+    def walk(section):
+      children = section._sections
+      for name, child in children.items():
+        children[name] = walk(child)
+      return self.section(section)
+    sections = config._sections
+    for name, section in sections.items():
+      sections[name] = walk(section)
+    return config
+
+
+class Parser:
+  """Parser for Edgerouter config.
+
+  Feed it whole inputs with parse(), or one line at a time with line() and
+  finish with end(). Lines are classified with plain string operations:
+
+    "firewall {"            section start, "name {" with any indent
+    "        rule 5003 {"
+    "}"                     section end, any indent
+    "    all-ping enable"   entry: key, then an optional value
+    ""                      first blank line after the body starts the footer
+
+  Anything before the first section is header, anything from the footer on
+  is kept verbatim. Given an Interner, each section is swapped for its
+  shared equal as soon as it ends.
+  """
+
+  def __init__(self, interner=None):
     self._config = Config()
+    self._interner = interner
     self._current = None
+    self._stack = []  # sections enclosing _current, outermost first
     # Track what part is currently being parsed; header, body, or footer
     self._mode = 0  # header
+    self._lineno = 0
+    self._blank = 0  # line number of a blank line inside a section
+
+  def _error(self, message, lineno=None):
+    lineno = lineno or self._lineno
+    return ParseError('line %d: %s' % (lineno, message), lineno)
 
   def line(self, line):
     """Parse next line into config."""
-    #print(line, file=sys.stderr)
-    # sample """firewall {"""
-    # sample """interfaces {"""
-    # sample """         site-to-site {"""
-    # sample """        rule 5003 {"""
-    new_section = re.match(r'( *)(.*) {', line)
-    # sample """}"""
-    # sample """         }"""  # i.e. lines up with new_section indent
-    end = re.match(r'( *)}', line)
-    if self._mode == 0:  # header
-      assert not end
-      if not new_section:
-        self._config.add_header(line)
-      else:  # First body line, is always a section starter
-        section = Section(self._config, new_section.group(1), new_section.group(2))
-        self._config.add_section(section)
-        self._current = section
-        #print('========== end header', file=sys.stderr)
-        self._mode = 1  # body
-    elif self._mode == 1:  # body
-      # sample """  all-ping enable"""
+    self._lineno += 1
+    if self._blank:
+      raise self._error('blank line inside section %r' % self._current.name, self._blank)
+    line = line.rstrip()
+    if self._mode == 2:  # footer
+      self._config.add_footer(line)
+      return
+    body = line.lstrip(' ')
+    if body.endswith(' {'):
+      # new section; sample """        rule 5003 {"""
+      name = sys.intern(body[:-2])
+      if self._current is None:
+        section = Section(0, name)
+        parent = self._config
+      else:
+        section = Section(len(self._stack) + 1, name)
+        parent = self._current
+      try:
+        parent.add_section(section)
+      except AssertionError:
+        raise self._error('duplicate section %r' % name) from None
+      if self._current is not None:
+        self._stack.append(self._current)
+      self._current = section
+      self._mode = 1  # body
+    elif self._mode == 0:  # header
+      if body.startswith('}'):
+        raise self._error("'}' before the first section")
+      self._config.add_header(line)
+    elif body.startswith('}'):
+      # sample """         }"""  # i.e. lines up with new_section indent
+      if self._current is None:
+        raise self._error("'}' without a section to end")
+      parent = self._stack.pop() if self._stack else None
+      if self._interner is not None:
+        (parent or self._config)._sections[self._current.name] = self._interner.section(self._current)
+      self._current = parent
+    elif body:
       # sample """            key value"""  # i.e. indent +4 spaces
-      entry = re.match(r'( *)(.+)', line)
-      if new_section:
-        section = Section(self._current, new_section.group(1), new_section.group(2))
-        self._current.add_section(section)
-        self._current = section
-      elif end:
-        #print('end', file=sys.stderr)
-        self._current = self._current.parent
-      elif entry:  # because this is a .* regex, it must come last
-        if ' ' in entry.group(2):
-          key, value = entry.group(2).split(' ', 1)
-          self._current.add_entry(Entry(self._current, key, value))
-        else:  # bare keyword, no value
-          self._current.add_entry(Entry(self._current, entry.group(2), None))
-      else:  # presume body -> footer
-        #print('========== begin footer', file=sys.stderr)
-        self._config.add_footer(line)
-        self._mode = 2  # footer
-    elif self._mode == 2:  # footer
+      if self._current is None:
+        raise self._error('entry outside of any section: %r' % body)
+      if ' ' in body:
+        key, value = body.split(' ', 1)
+        self._current.add_entry(Entry(sys.intern(key), value))
+      else:  # bare keyword, no value
+        self._current.add_entry(Entry(sys.intern(body), None))
+    else:  # body -> footer
+      if self._current is not None:
+        self._blank = self._lineno  # an error, unless it's the end of input
+        return
       self._config.add_footer(line)
+      self._mode = 2  # footer
+
+  def end(self):
+    """No more input. Raises ParseError if a section is still open."""
+    if self._current is not None:
+      raise self._error('input ends inside section %r' % self._current.name)
+    return self._config
+
+  def parse(self, source):
+    """Parse all of source and return the Config.
+
+    source is a str, bytes, an mmap, or a text or binary file object (or
+    any other iterable of lines). Input is read one line at a time; like
+    str.split('\\n'), a final newline yields one last empty line.
+    """
+    line = self.line
+    # Nothing here is garbage, yet the collector would keep rescanning the
+    # growing tree; pausing it is worth about a third of the parse time.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+      for text in _lines(source):
+        line(text)
+    finally:
+      if enabled:
+        gc.enable()
+    return self.end()
 
   @property
   def config(self):
@@ -401,56 +786,349 @@ class Parser:
     return self._config
 
 
-def main(argv):
-  """Main."""
-  assert len(argv) == 3
-  assert argv[1]
-  assert argv[2]
-
-  lhs_fn = argv[1]
-  rhs_fn = argv[2]
-
-  # parse
-  parse = Parser()
-  with open(lhs_fn, 'r') as fh:
-    for line in fh.read().split('\n'):
-      line = line.rstrip()
-      parse.line(line)
-  lhs = parse.config
-  # TEST #
-  #print(lhs)
-  #sys.exit(0)
-  # TEST #
-  parse = Parser()
-  with open(rhs_fn, 'r') as fh:
-    for line in fh.read().split('\n'):
-      line = line.rstrip()
-      parse.line(line)
-  rhs = parse.config
-
+def _lines(source):
+  """Yield the lines of source without their '\\n', see Parser.parse."""
+  if isinstance(source, str):
+    yield from source.split('\n')
+    return
+  if isinstance(source, (bytes, bytearray)):
+    yield from source.decode('utf-8').split('\n')
+    return
+  if isinstance(source, mmap.mmap):  # iterating an mmap yields single bytes
+    source = iter(source.readline, b'')
+  text = ''
+  for text in source:
+    if isinstance(text, bytes):
+      text = text.decode('utf-8')
+    if not text.endswith('\n'):
+      break
+    yield text[:-1]
+  else:
+    text = ''
+  yield text  # last line; '' if the input is empty or ends in a newline
+
+
+def parse(source, interner=None):
+  """Returns the Config parsed from source; see Parser.parse."""
+  return Parser(interner).parse(source)
+
+
+def _freezeSection(section):
+  return (section._name,
+          tuple((k, tuple(entry.value for entry in entries._ordered()))
+                for k, entries in section._entries.items()),
+          tuple(_freezeSection(child) for child in section._sections.values()))
+
+
+def dumps(config):
+  """Returns config serialized for loads(); much faster to load than to parse."""
+  return marshal.dumps((PARSER_VERSION, tuple(config.header),
+                        tuple(_freezeSection(section) for section in config._sections.values()),
+                        tuple(config.footer)))
+
+
+def _thawSection(depth, frozen):
+  name, entries, sections = frozen
+  section = Section(depth, sys.intern(name))
+  for key, values in entries:
+    key = sys.intern(key)
+    items = [Entry(key, value) for value in values]
+    collection = Entries(depth + 1, items[0])
+    if len(items) > 1:
+      collection._entries = items
+      collection._byValue = {entry._value: entry for entry in reversed(items)}
+    section._entries[key] = collection
+  children = section._sections
+  for frozen_child in sections:
+    children[frozen_child[0]] = _thawSection(depth + 1, frozen_child)
+  return section
+
+
+def loads(data, interner=None):
+  """Inverse of dumps(). Raises Error for data from another PARSER_VERSION.
+
+  Shares subtrees through interner, an Interner, if given.
+  """
+  enabled = gc.isenabled()
+  gc.disable()  # see Parser.parse
+  try:
+    version, header, sections, footer = marshal.loads(data)
+    if version != PARSER_VERSION:
+      raise Error('parser version %s, not %s' % (version, PARSER_VERSION))
+    config = Config()
+    config._header = list(header)
+    config._footer = list(footer)
+    for frozen in sections:
+      section = _thawSection(0, frozen)
+      config._sections[section.name] = section
+    if interner is not None:
+      interner.intern(config)
+  finally:
+    if enabled:
+      gc.enable()
+  return config
+
+
+class ParseCache:
+  """On-disk cache of parsed configs, keyed by the sha1 of their content.
+
+  Each entry is one file of dumps() output named <sha1>.v<PARSER_VERSION>.
+  Hits refresh the file's mtime; once the files add up to more than
+  max_bytes the least recently used go. Entries of other parser versions
+  are deleted on sight. Files not named like an entry are never touched,
+  so directory may be shared.
+  """
+
+  _NAME = re.compile(r'[0-9a-f]{40}\.v(\d+)')
+
+  def __init__(self, directory=None, max_bytes=256 * 1024 * 1024):
+    if directory is None:
+      directory = os.path.join(
+          os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'edgerouter-configdiff')
+    self._dir = directory
+    self._maxBytes = max_bytes
+    self._suffix = '.v%d' % PARSER_VERSION
+    self._version = str(PARSER_VERSION)
+    os.makedirs(directory, exist_ok=True)
+    self._size = 0
+    for name, size, unused_mtime in self._files():
+      self._size += size
+
+  def _files(self):
+    """Yield (name, size, mtime) of current entries; delete stale ones."""
+    for entry in os.scandir(self._dir):
+      name = entry.name
+      match = self._NAME.fullmatch(name)
+      if not match:  # not ours
+        continue
+      try:
+        if match.group(1) != self._version:
+          os.unlink(entry.path)
+          continue
+        st = entry.stat()
+      except FileNotFoundError:  # another process got there first
+        continue
+      yield name, st.st_size, st.st_mtime
+
+  def parse(self, data, interner=None):
+    """Returns the Config for data (bytes), parsing it only on a miss.
+
+    interner is as for parse().
+    """
+    fn = os.path.join(self._dir, hashlib.sha1(data).hexdigest() + self._suffix)
+    try:
+      with open(fn, 'rb') as fh:
+        config = loads(fh.read(), interner)
+      os.utime(fn)
+      return config
+    except FileNotFoundError:
+      pass
+    except (Error, ValueError, EOFError, TypeError):  # torn or foreign file
+      pass
+    config = parse(data, interner)
+    frozen = dumps(config)
+    fd, tmp = tempfile.mkstemp(dir=self._dir, prefix='.')
+    with os.fdopen(fd, 'wb') as fh:
+      fh.write(frozen)
+    os.replace(tmp, fn)
+    self._size += len(frozen)
+    if self._size > self._maxBytes:
+      self._evict()
+    return config
+
+  def _evict(self):
+    """Delete least recently used entries until under max_bytes."""
+    files = sorted(self._files(), key=lambda f: f[2])
+    self._size = sum(f[1] for f in files)
+    for name, size, unused_mtime in files:
+      if self._size <= self._maxBytes:
+        break
+      try:
+        os.unlink(os.path.join(self._dir, name))
+      except FileNotFoundError:
+        pass
+      self._size -= size
+
+
+def _load(fn, cache=None):
+  """Parse file fn; exit with the line number of malformed input."""
+  try:
+    with open(fn, 'rb') as fh:
+      if cache is None:
+        return parse(fh)
+      return cache.parse(fh.read())
+  except ParseError as e:
+    sys.exit('%s:%s' % (fn, e))
+
+
+def diff(lhs, rhs, context=None):
+  """Yield the diff of two Configs line by line: header, body, footer.
+
+  context is as for udiff(); None shows everything.
+  """
   # diff headers
   if lhs.header != rhs.header:
     # TODO: diff header properly
     for head in lhs.header:
-      print('-%s' % head)
+      yield '-%s' % head
     for head in rhs.header:
-      print('+%s' % head)
+      yield '+%s' % head
   else:
     for head in lhs.header:
-      print(' %s' % head)
+      yield ' %s' % head
 
-  print(lhs.udiff(rhs))
+  yield from lhs.udiff(rhs, context)
 
   # diff footer
   if lhs.footer != rhs.footer:
     # TODO: diff footer properly
     for foot in lhs.footer:
-      print('-%s' % foot)
+      yield '-%s' % foot
     for foot in rhs.footer:
-      print('+%s' % foot)
+      yield '+%s' % foot
   else:
     for foot in lhs.footer:
-      print(' %s' % foot)
+      yield ' %s' % foot
+
+
+def snapshots(paths):
+  """Returns [(label, source)] for a series of configs, oldest first.
+
+  paths are files, globs, directories of files, or archive.Store
+  directories, which contribute every version. source is (path, None) for a
+  file and (store, version) for an archived version. Files are ordered by
+  archive.snapshotTime().
+  """
+  found = []
+  for arg in paths:
+    matches = sorted(glob.glob(arg)) if any(c in arg for c in '*?[') else [arg]
+    for path in matches:
+      if os.path.isfile(os.path.join(path, 'index')):  # an archive.Store
+        for version, ts in archive.Store(path).versions():
+          found.append((ts, '%s@%d' % (path, version), (path, version)))
+        continue
+      if os.path.isdir(path):
+        names = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                 if not name.startswith('.')]
+      else:
+        names = [path]
+      for fn in names:
+        if os.path.isfile(fn) and not os.path.islink(fn):
+          found.append((archive.snapshotTime(fn), fn, (fn, None)))
+  found.sort(key=lambda f: f[0])  # stable: ties keep argument order
+  return [(label, source) for unused_ts, label, source in found]
+
+
+# Per worker process state, see _initWorker.
+_cache = None
+_context = None
+_stores = {}
+
+
+def _initWorker(cache_dir, cache_bytes, context):
+  global _cache, _context
+  if cache_bytes:
+    _cache = ParseCache(cache_dir, max_bytes=cache_bytes)
+  _context = context
+
+
+def _read(source):
+  path, version = source
+  if version is None:
+    with open(path, 'rb') as fh:
+      return fh.read()
+  if path not in _stores:
+    _stores[path] = archive.Store(path)
+  return _stores[path].get(version).encode('utf-8')
+
+
+def _diffChunk(chunk):
+  """Diff consecutive snapshots of chunk, parsing each one once.
+
+  Returns [(lhs label, rhs label, diff or None if identical, error or None)].
+  """
+  configs = []
+  interner = Interner()  # neighbours share all but what changed
+  for label, source in chunk:
+    try:
+      data = _read(source)
+      configs.append((_cache.parse(data, interner) if _cache else parse(data, interner), None))
+    except (OSError, Error) as e:
+      configs.append((None, '%s:%s' % (label, e)))
+  retval = []
+  for i in range(1, len(chunk)):
+    (lhs, lhs_err), (rhs, rhs_err) = configs[i - 1], configs[i]
+    if lhs_err or rhs_err:
+      retval.append((chunk[i - 1][0], chunk[i][0], None, lhs_err or rhs_err))
+    elif lhs == rhs:
+      retval.append((chunk[i - 1][0], chunk[i][0], None, None))
+    else:
+      retval.append((chunk[i - 1][0], chunk[i][0], '\n'.join(diff(lhs, rhs, _context)), None))
+  return retval
+
+
+def series(snaps, jobs=None, cache_dir=None, cache_bytes=0, context=None, chunk=None):
+  """Yield _diffChunk() results for every consecutive pair of snaps, in order.
+
+  Runs of snapshots go to a pool of jobs processes. Neighbouring runs share
+  one snapshot, so only those are parsed twice (a parse cache hit, given
+  cache_bytes). Results stream in order as soon as they are ready.
+  """
+  if len(snaps) < 2:
+    return
+  jobs = jobs or os.cpu_count() or 1
+  if chunk is None:
+    chunk = max(2, min(33, len(snaps) // (jobs * 4) + 1))
+  chunks = [snaps[i:i + chunk] for i in range(0, len(snaps) - 1, chunk - 1)]
+  if jobs == 1:
+    _initWorker(cache_dir, cache_bytes, context)
+    for c in chunks:
+      yield from _diffChunk(c)
+    return
+  with multiprocessing.Pool(jobs, _initWorker, (cache_dir, cache_bytes, context)) as pool:
+    for results in pool.imap(_diffChunk, chunks):
+      yield from results
 
 
-main(sys.argv)
+def main(argv):
+  """Main."""
+  parser = argparse.ArgumentParser(
+      description='Diff two EdgeRouter config files, or every consecutive pair of a series')
+  parser.add_argument('--cache', help='parse cache directory; default=~/.cache/edgerouter-configdiff')
+  parser.add_argument('--no-cache', action='store_true', help='always parse from scratch')
+  parser.add_argument('--cache-size', type=int, default=256, help='parse cache limit in MB; default=256')
+  parser.add_argument('-U', '--context', type=int, default=3,
+                      help='unchanged lines to show around each change; default=3')
+  parser.add_argument('--full', action='store_true', help='show every line, changed or not')
+  parser.add_argument('-j', '--jobs', type=int, help='worker processes for a series; default=one per core')
+  parser.add_argument('paths', nargs='+',
+                      help='two config files; or files, globs (e.g. "Logs/2025/*"), directories '
+                           'and archive stores (e.g. Logs/EdgeRouterScraper), diffed in time order')
+  args = parser.parse_args(argv[1:])
+  cache_bytes = 0 if args.no_cache else args.cache_size * 1024 * 1024
+  context = None if args.full else args.context
+
+  if len(args.paths) == 2 and all(os.path.isfile(p) for p in args.paths):
+    cache = ParseCache(args.cache, max_bytes=cache_bytes) if cache_bytes else None
+    lhs = _load(args.paths[0], cache)
+    rhs = _load(args.paths[1], cache)
+    for line in diff(lhs, rhs, context):
+      print(line)
+    return
+
+  failed = False
+  for lhs_label, rhs_label, text, err in series(
+      snapshots(args.paths), jobs=args.jobs, cache_dir=args.cache, cache_bytes=cache_bytes,
+      context=context):
+    if err:
+      print(err, file=sys.stderr)
+      failed = True
+    elif text is not None:
+      print('--- %s\n+++ %s' % (lhs_label, rhs_label))
+      print(text, flush=True)
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
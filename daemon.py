@@ -1,137 +1,756 @@
 #!/usr/bin/python3
-"""Scrape edgerouter via ssh commands
+"""Scrape edgerouters via ssh commands
 
-Archive config once a minute into Logs/YYYY/YYYYmmdd-HHMMSS
+Poll every router given by --ip (repeatable) or --routers FILE concurrently.
+
+Check config once a minute and archive it when it changes as the next
+version in Logs/<router>/ (see archive.py); Logs/<router>/latest is a plain
+copy of the newest.
 
 Publish prometheus metrics on port 8000:
-  reachable{group= interface=eth[0-4] is={true,false}}
-  status{group= interface=eth[0-4] is={failover,active,inactive}}
+  reachable{router= group= interface=eth[0-4] is={true,false}}
+  status{router= group= interface=eth[0-4] is={failover,active,inactive}}
+  weight{router= group= interface=}   percent of new flows
+  flows_total{router= group= interface= flow={wan_out,wan_in,local_icmp,local_dns,local_data}}
+  config_version{router=}
+  transitions_total{router= group= interface= event={failover_started,failover_ended,reachable_flipped}}
+  last_transition_timestamp_seconds{router= group= interface= event=}
+and the scraper's own:
+  poll_seconds{stage={connect,status,config} router=}   histogram; connect is
+                                                the time to the first byte
+  poll_parse_seconds{stage={status,config} router=}     histogram
+  archive_seconds{stage={write,configdiff} router=}     histogram
+  poll_timeouts_total, poll_kills_total, poll_nonzero_exits_total and
+  poll_stderr_total{stage={connect,status,config,ssh,stream} router=}
+where stage ssh is the ssh command itself, outside any remote command, and
+stream a --stream session.
 The metrics are split out into every permutation to make boolean graphs
-and alerts easier to understand.
+and alerts easier to understand. /flows on the same port has the last
+--flow-samples flow counters of every interface as JSON, with rates; see
+flowring.py.
+
+With --stream, each router instead runs wlbGetStatus every that many
+seconds in one long-lived ssh session, which is restarted with backoff
+when it dies or goes quiet.
+
+With --scrape-ttl, load-balance status is polled on demand instead: a
+scrape finding it older than the TTL polls every such router first, and
+waits up to --scrape-wait seconds for the answers before serving what it
+has. Concurrent scrapes share the polls in flight.
+
+With --fake RECORDING, no router is needed: every --ip replays the
+outputs recorded by fakerouter.py.
 """
 
 import argparse
-import datetime
+import asyncio
+import collections
+import concurrent.futures
 import logging
+import math
 import os
+import random
 import signal
+import socketserver
+import tempfile
 import threading
 import time
+import wsgiref.simple_server
 
 import prometheus_client
+import prometheus_client.core
+import archive
+import fakerouter
+import flowring
+import history
 import poll
 
 
+class LoadBalanceCollector(object):
+  """Renders the metrics of each router's newest LoadBalance.
+
+  Every poll hands over a whole parsed poll.LoadBalance, which nothing
+  changes afterwards, and update() swaps it in with one assignment; scrapes
+  render whatever is current then. Publishing costs the same however many
+  series a router has, and interfaces that disappear are simply no longer
+  rendered.
+
+  For reachable and status each interface gets one series per allowed
+  value, 1 for the one it has and 0 for the rest; all -1 if it reported
+  something else or nothing. weight and flows are as reported.
+  """
+
+  LABELS = ('router', 'group', 'interface', 'is')
+  # metric name, also the poll.LoadBalanceGroupInterface property -> (help, allowed values)
+  METRICS = {
+    'reachable': ('is the interface reachable?', ('true', 'false')),
+    'status': ('is the interface active?', ('active', 'inactive', 'failover')),
+  }
+
+  def __init__(self):
+    self._snapshots = {}  # router -> poll.LoadBalance; replaced, never changed
+    self.refresh = None  # called with no arguments before every scrape
+
+  def update(self, router, load_balance):
+    """Publish load_balance, a complete poll.LoadBalance, for router."""
+    snapshots = dict(self._snapshots)
+    snapshots[router] = load_balance
+    self._snapshots = snapshots
+
+  def describe(self):
+    for name, (doc, unused_allowed) in self.METRICS.items():
+      yield prometheus_client.core.GaugeMetricFamily(name, doc, labels=self.LABELS)
+    yield from self._numbers()
+
+  def _numbers(self):
+    """Returns empty weight and flows metric families."""
+    return (prometheus_client.core.GaugeMetricFamily(
+                'weight', 'percent of new flows given to the interface', labels=self.LABELS[:3]),
+            prometheus_client.core.CounterMetricFamily(
+                'flows', 'flows given to the interface', labels=self.LABELS[:3] + ('flow',)))
+
+  def collect(self):
+    if self.refresh:
+      self.refresh()
+    snapshots = self._snapshots  # one consistent view for the whole scrape
+    for name, (doc, allowed) in self.METRICS.items():
+      family = prometheus_client.core.GaugeMetricFamily(name, doc, labels=self.LABELS)
+      for router, load_balance in sorted(snapshots.items()):
+        for g in load_balance.groups:
+          for interface in g.interfaces:
+            value = getattr(interface, name)
+            known = value in allowed
+            for state in allowed:
+              family.add_metric((router, g.name, interface.name, state),
+                                (1 if value == state else 0) if known else -1)
+      yield family
+    weight, flows = self._numbers()
+    for router, load_balance in sorted(snapshots.items()):
+      for g in load_balance.groups:
+        for interface in g.interfaces:
+          labels = (router, g.name, interface.name)
+          if interface.weight is not None:
+            weight.add_metric(labels, interface.weight)
+          if interface.flows is not None:
+            for flow, count in zip(interface.flows.NAMES, interface.flows.counts()):
+              if count is not None:
+                flows.add_metric(labels + (flow,), count)
+    yield weight
+    yield flows
+
+
+# Registered before METRICS: a scrape renders collectors in registration
+# order, and the polls COLLECTOR.refresh may run should be in the timings
+# and counters of the same scrape.
+COLLECTOR = LoadBalanceCollector()
+prometheus_client.REGISTRY.register(COLLECTOR)
+
+_SECONDS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 25, 50, 100)
+
 METRICS = {
-  'reachable': prometheus_client.Gauge('reachable', 'is the interface reachable?', ['group', 'interface', 'is']),
-  'status': prometheus_client.Gauge('status', 'is the interface active?', ['group', 'interface', 'is']),
+  'config_version': prometheus_client.Gauge('config_version', 'newest archived config version', ['router']),
+  'transitions': prometheus_client.Counter(
+      'transitions', 'load-balance transitions seen', ['router', 'group', 'interface', 'event']),
+  'last_transition': prometheus_client.Gauge(
+      'last_transition_timestamp_seconds', 'when a load-balance transition was last seen',
+      ['router', 'group', 'interface', 'event']),
+  'poll_seconds': prometheus_client.Histogram(
+      'poll_seconds', 'ssh time to first byte (connect) and per remote command', ['stage', 'router'],
+      buckets=_SECONDS),
+  'poll_parse_seconds': prometheus_client.Histogram(
+      'poll_parse_seconds', 'time spent parsing remote command output', ['stage', 'router'],
+      buckets=_SECONDS),
+  'archive_seconds': prometheus_client.Histogram(
+      'archive_seconds', 'time to archive a new config version and index its paths', ['stage', 'router'],
+      buckets=_SECONDS),
+  'timeouts': prometheus_client.Counter(
+      'poll_timeouts', 'polls timed out, by what was running', ['stage', 'router']),
+  'kills': prometheus_client.Counter('poll_kills', 'signals sent to stop ssh', ['stage', 'router']),
+  'nonzero_exits': prometheus_client.Counter(
+      'poll_nonzero_exits', 'commands that exited non-zero', ['stage', 'router']),
+  'stderr': prometheus_client.Counter('poll_stderr', 'commands that wrote to stderr', ['stage', 'router']),
 }
 
-# TODO: Create a prometheus metric to track time spent and requests made.
-##REQUEST_TIME = prometheus_client.Summary('request_processing_seconds', 'Time spent processing request')
-##
-### Decorate function with metric.
-##@REQUEST_TIME.time()
-##def process_request(t):
-##  """A dummy function that takes some time."""
-##  time.sleep(t)
 
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+  daemon_threads = True
+
+
+class _QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+  def log_message(self, format, *args):
+    logging.debug(format, *args)
+
+
+def serve(port, flows):
+  """Serve /flows from flows, a flowring.FlowHistory, and metrics on every
+  other path, from a background thread.
+  """
+  metrics = prometheus_client.make_wsgi_app()
 
-class Processor(threading.Thread):
+  def app(environ, start_response):
+    if environ.get('PATH_INFO') == '/flows':
+      return flows.wsgi(environ, start_response)
+    return metrics(environ, start_response)
 
-  def __init__(self, ip, **kwargs):
-    super().__init__(**kwargs)
-    self._ip = ip
-    self._pid = None
-    self.load_balance = None
+  server = wsgiref.simple_server.make_server('', port, app, _ThreadingWSGIServer, _QuietHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
 
-  def run(self):
-    logging.debug('Processor.run')
-    c = poll.SshConnection(self._ip)
-    self.load_balance = poll.ShowLoadBalanceStatus(c)
-    self.load_balance.Run(callback=self.setPid)
-    logging.debug('Processor.run end')
+# longest stdout line we accept; config.boot lines are short.
+_LINE_LIMIT = 1024 * 1024
 
-  def setPid(self, pid):
-    self._pid = pid
 
-  def kill(self):
+async def _drain(stream, limit=poll.RemoteCommand.STDERR_LIMIT):
+  """Read stream to EOF so its pipe never fills up; keep the first limit bytes."""
+  kept = []
+  size = 0
+  while True:
+    chunk = await stream.read(4096)
+    if not chunk:
+      return b''.join(kept)
+    if size < limit:
+      kept.append(chunk[:limit - size])
+      size += len(chunk)
+
+
+async def _communicate(proc, feed, killed=None):
+  """Feed proc's stdout lines to feed() until EOF or feed() returns True.
+
+  Returns (returncode, stderr bytes). killed is as for _reap().
+  """
+  err = asyncio.create_task(_drain(proc.stderr))
+  try:
+    async for raw in proc.stdout:
+      if raw.endswith(b'\n'):
+        raw = raw[:-1]
+      if feed(raw.decode('utf-8')):
+        break
+    else:
+      return await proc.wait(), await err
+    # feed() has all it wants; give the command a moment to exit on its own.
     try:
-      os.kill(self._pid, signal.SIGINT)
+      await asyncio.wait_for(proc.wait(), 1)
+    except asyncio.TimeoutError:
+      await _reap(proc, killed=killed)
+    return proc.returncode, await err
+  finally:
+    err.cancel()
+
+
+async def _reap(proc, grace=3, killed=None):
+  """Stop proc and everything it started, then collect its exit status.
+
+  Commands run in their own session, so the process group holds ssh and any
+  helpers it forked. SIGTERM first, SIGKILL if still around after grace.
+  killed(signal) is called for each signal sent.
+  """
+  if proc.returncode is not None:
+    return
+  for sig in (signal.SIGTERM, signal.SIGKILL):
+    try:
+      os.killpg(proc.pid, sig)
     except ProcessLookupError:
       pass
-    time.sleep(3)
+    else:
+      if killed:
+        killed(sig)
     try:
-      os.kill(self._pid, signal.SIGKILL)
-    except ProcessLookupError:
+      await asyncio.wait_for(proc.wait(), grace)
+      return
+    except asyncio.TimeoutError:
       pass
-    
 
-class Archiver(threading.Thread):
-  """Archive the config if different."""
 
-  # TODO: push config into rcs, publish the version #
+class Archiver(object):
+  """Archive the config if different.
+
+  Snapshots go into an archive.Store in logdir: numbered versions,
+  delta-compressed, with logdir/latest as a plain copy of the newest.
+  Each new version is also added to the history.PathIndex.
+  """
 
-  def __init__(self, ip, logdir, **kwargs):
-    super().__init__(**kwargs)
-    self._ip = ip
+  def __init__(self, logdir, router=None):
     self._logdir = logdir
+    self._router = router or os.path.basename(os.path.normpath(logdir))
+    self._store = archive.Store(logdir)
+    self._paths = history.PathIndex(logdir)
+
+  @property
+  def version(self):
+    """Newest archived version number; 0 before the first."""
+    return self._store.version
+
+  def begin(self):
+    """Returns a temporary file to stream a new config into.
+
+    Hand it to commit() or abort() when done.
+    """
+    return tempfile.NamedTemporaryFile('w', dir=self._logdir, prefix='.incoming-', delete=False)
+
+  def abort(self, fh):
+    """Throw away a config started with begin()."""
+    fh.close()
+    os.unlink(fh.name)
+
+  def commit(self, fh):
+    """Store fh as the next version unless it matches the newest one.
+
+    Returns the newest version number.
+    """
+    logging.debug('Archiver.commit')
+    fh.close()
+    try:
+      if os.path.getsize(fh.name) == 0:  # don't archive empty configs
+        return self._store.version
+      # The store hashes and deltas whole texts, so a new version is read
+      # back in full here. Streaming it to disk still keeps the transfer,
+      # and the unchanged or broken ones never archived, out of memory.
+      with open(fh.name, 'r') as new:
+        with METRICS['archive_seconds'].labels(stage='write', router=self._router).time():
+          version = self._store.commit(new.read())
+    finally:
+      os.unlink(fh.name)
+    try:
+      with METRICS['archive_seconds'].labels(stage='configdiff', router=self._router).time():
+        self._paths.update(self._store)
+    except Exception:  # the archive is what matters; history.py catches up later
+      logging.exception('%s: path index not updated', self._logdir)
+    logging.debug('Archiver.commit end, version %d', version)
+    return version
+
+
+class Engine(object):
+  """Poll every router from one event loop.
+
+  Every status_interval seconds each router gets one ssh session running a
+  poll.Batch: load-balance status, plus the config once config_interval has
+  passed. Status is published the moment its section ends, so a slow config
+  transfer never delays it, and a hung router only ever costs its own
+  timeout.
+
+  The router compares config.boot against the md5 of the last config we
+  archived and only sends it when it changed (gzipped when larger than
+  compress_over bytes), so checking every minute is cheap.
+
+  Given scrape_ttl, status is instead polled when scrape() finds it older
+  than that, and the schedule's config checks leave it out. Either way a
+  router has at most one poll in flight; anyone wanting one while it runs
+  waits for that one, and if it leaves out the status they want, starts
+  another after it.
+
+  While a router's load balancing is unsettled, i.e. an interface is
+  unreachable or inactive or either changed since the poll before, its
+  status is polled every fast_interval seconds instead, scrape_ttl or
+  not, until it has been settled for a whole status_interval. No router
+  gets more than max_calls ssh sessions a minute, whoever asks for them.
+
+  Given stream, status comes from a poll.StatusStream per router instead,
+  a session that sends it every stream seconds, unsettled or not; the
+  schedule only runs the config checks.
+  """
+
+  def __init__(self, conns, logdir, timeout=50, jitter=5,
+               status_interval=60, config_interval=60, compress_over=32768,
+               scrape_ttl=None, flows=None, fast_interval=5, max_calls=20, stream=None):
+    self._conns = conns
+    self._flows = flows  # flowring.FlowHistory, if any
+    self._logdir = logdir
+    self._timeout = timeout
+    self._jitter = jitter
+    self._statusInterval = status_interval
+    self._configInterval = config_interval
+    self._compressOver = compress_over
+    self._scrapeTtl = scrape_ttl
+    self._fastInterval = fast_interval
+    self._maxCalls = max_calls
+    self._stream = stream
+    self._trackers = {router: poll.LoadBalanceTracker() for router in conns}
+    self._fastUntil = {}  # router -> time.monotonic() it may slow down again
+    self._wake = collections.defaultdict(asyncio.Event)  # set when a router gets unsettled
+    self._calls = collections.defaultdict(collections.deque)  # router -> recent ssh start times
+    self._loop = None  # set by run()
+    # conn.Prepare() may block for a while, e.g. starting an ssh control
+    # master to a router that doesn't answer; it gets threads of its own
+    # so that never holds up archiving, which uses the default executor.
+    self._setup = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(len(conns), 16)), thread_name_prefix='ssh-setup')
+    self._inflight = {}  # router -> (asyncio.Task of its current poll, whether it polls status)
+    self._polled = {}  # router -> time.monotonic() of its newest status
+    self._configMd5 = {}  # router -> md5 of the config last archived
+    self._archivers = {}
+    for router in conns:
+      self._archivers[router] = Archiver(os.path.join(logdir, router), router)
+      METRICS['config_version'].labels(router=router).set(self._archivers[router].version)
+
+  async def _prepare(self, conn, timeout):
+    """conn.Prepare() on the ssh setup threads.
 
-  def run(self):
-    logging.debug('Archiver.run')
-    c = poll.SshConnection(self._ip)
-    # download the config
-    conf = poll.ShowConfig(c)
-    conf.Run()
-    now = time.time()
-    dt = datetime.datetime.fromtimestamp(now)
-    latest_fn = os.path.join(self._logdir, 'latest')
+    Raises asyncio.TimeoutError after timeout seconds; Prepare() then
+    finishes in the background.
+    """
+    loop = asyncio.get_running_loop()
+    await asyncio.wait_for(loop.run_in_executor(self._setup, conn.Prepare), timeout)
+
+  async def _exec(self, conn, cmd, feed, killed=None):
+    """Run cmd on conn, handing each stdout line to feed() as it arrives.
+
+    Reading stops early once feed() returns True. Returns (returncode,
+    stderr bytes). Raises asyncio.TimeoutError after self._timeout seconds,
+    conn.Prepare() included. On timeout or cancellation the command's whole
+    process group is reaped, see _reap() for killed.
+    """
+    start = time.monotonic()
+    await self._prepare(conn, self._timeout)
+    proc = await asyncio.create_subprocess_exec(
+        *conn.Command(cmd),
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=_LINE_LIMIT,
+        start_new_session=True)
+    try:
+      return await asyncio.wait_for(_communicate(proc, feed, killed),
+                                    max(0, start + self._timeout - time.monotonic()))
+    except BaseException:  # timeout and cancellation alike
+      await asyncio.shield(_reap(proc, killed=killed))
+      raise
+
+  async def cycle(self, router, config=False, status=True):
+    """One ssh session to router: publish its status and/or archive its
+    config, as asked.
+    """
+    conn = self._conns[router]
+    batch = poll.Batch(conn)
+    if status:
+      lines = []
+      batch.Add('status', poll.LoadBalanceTracker.COMMAND, lines.append,
+                lambda section: self._statusDone(router, lines, section))
+    if config:
+      archiver = self._archivers[router]
+      fh = archiver.begin()
+      conf = poll.ShowConfig(conn, sink=fh,
+                             unless_md5=self._configMd5.get(router, ''),
+                             compress_over=self._compressOver)
+      batch.Add('config', conf.COMMAND, conf.Feed, conf.End)
+
+    def stage():
+      return batch.running or ('ssh' if batch.firstLine else 'connect')
+
+    def killed(unused_sig):
+      METRICS['kills'].labels(stage=stage(), router=router).inc()
+
+    start = time.monotonic()
     try:
-      with open(latest_fn, 'r') as fh:
-        old_config = fh.read()
-    except FileNotFoundError:
-      old_config = ''
-    new_config = str(conf)
-    if old_config == new_config:
+      returncode, err = await self._exec(conn, batch.Command(), batch.Feed, killed)
+    except BaseException as e:
+      if isinstance(e, asyncio.TimeoutError):
+        METRICS['timeouts'].labels(stage=stage(), router=router).inc()
+      if config:
+        archiver.abort(fh)
+      raise
+    finally:
+      _observeBatch(router, batch, start)
+    if returncode and not batch.done:  # 255 is ssh's own failure
+      METRICS['nonzero_exits'].labels(stage='ssh', router=router).inc()
+    if err:
+      METRICS['stderr'].labels(stage='ssh', router=router).inc()
+      logging.warning('%s: ssh exited %s: %s', router, returncode, err.decode('utf-8', 'replace'))
+    if not config:
+      return
+    if not conf.done:
+      archiver.abort(fh)
+      logging.error('%s: config incomplete (exit %s), not archived: %s',
+                    router, batch['config'].returncode, batch['config'].err)
+      return
+    if not conf.changed:
+      archiver.abort(fh)
+      return
+    # disk i/o; keep it off the event loop.
+    version = await asyncio.get_running_loop().run_in_executor(None, archiver.commit, fh)
+    self._configMd5[router] = conf.md5
+    METRICS['config_version'].labels(router=router).set(version)
+
+  def _statusDone(self, router, lines, section):
+    """Publish the status in lines, wlbGetStatus output, unless it's unchanged."""
+    if section.returncode != 0:
+      logging.error('%s: %s exited %s: %s', router, ' '.join(section.cmd),
+                    section.returncode, section.err)
+      return
+    tracker = self._trackers[router]
+    previous = tracker.links
+    start = time.perf_counter()
+    transitions = tracker.Update(lines)
+    section.parseSeconds += time.perf_counter() - start
+    now = time.monotonic()
+    self._polled[router] = now
+    if transitions is None:
+      logging.debug('%s: status unchanged', router)
+    else:
+      logging.debug('harvesting data from %s', router)
+      _checkLoadBalance(router, tracker.status)
+      COLLECTOR.update(router, tracker.status)
+      if self._flows is not None:
+        self._flows.add(router, tracker.status, time.time())
+      for transition in transitions:
+        _publishTransition(router, transition)
+    if self._stream:
+      return  # the stream already sends status every few seconds
+    changed = transitions is not None and previous and tracker.links != previous
+    if changed or any(r != 'true' or s == 'inactive' for r, s in tracker.links.values()):
+      if self._fastUntil.get(router, 0) <= now:
+        logging.info('%s: load balancing unsettled, polling every %ss', router, self._fastInterval)
+        self._wake[router].set()
+      self._fastUntil[router] = now + self._statusInterval
+
+  def _fast(self, router):
+    """True while router is polled every fast_interval seconds."""
+    return bool(self._fastInterval) and self._fastUntil.get(router, 0) > time.monotonic()
+
+  def _interval(self, router):
+    """Seconds between router's scheduled polls from now on."""
+    if self._stream:
+      return self._configInterval
+    interval = self._statusInterval if self._scrapeTtl is None else self._configInterval
+    if self._fast(router):
+      return min(interval, self._fastInterval)
+    return interval
+
+  async def _throttle(self, router):
+    """Wait until router may have another ssh session under max_calls a minute."""
+    if not self._maxCalls:
       return
-    new_fn = '%04d%02d%02d-%02d%02d%02d' % (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
-    new_dir = os.path.join(self._logdir, '%04d' % dt.year)
+    calls = self._calls[router]
+    while True:
+      now = time.monotonic()
+      while calls and calls[0] <= now - 60:
+        calls.popleft()
+      if len(calls) < self._maxCalls:
+        break
+      await asyncio.sleep(calls[0] + 60 - now)
+    calls.append(now)
+
+  async def _poll(self, router, config, status, after=None):
+    """cycle(), once the after task is done, with its errors logged."""
+    if after is not None:
+      await asyncio.wait([after])
     try:
-      os.mkdir(new_dir)
-    except FileExistsError:
-      pass  # dir already exists
-    if not new_config:  # don't write 0 byte files
+      await self._throttle(router)
+      await self.cycle(router, config=config, status=status)
+    except asyncio.TimeoutError:
+      logging.error('%s: timed out after %ss', router, self._timeout)
+    except Exception:
+      logging.exception('%s: poll failed', router)
+
+  def _start(self, router, config=False, status=True):
+    """Returns the task of router's poll in flight, starting one if needed.
+
+    One in flight that leaves out the status wanted gets a poll queued
+    behind it.
+    """
+    task, polls_status = self._inflight.get(router, (None, False))
+    if task is not None and not task.done():
+      if polls_status or not status:
+        return task
+      after = task
+    else:
+      after = None
+    task = asyncio.create_task(self._poll(router, config, status, after))
+    self._inflight[router] = (task, status)
+    return task
+
+  async def _schedule(self, router):
+    """Run cycle(router) after up to jitter seconds, then every _interval().
+
+    Deadlines advance in whole intervals of the monotonic clock, so a slow
+    poll never shifts the ones after it; slots missed altogether are
+    skipped. A router turning unsettled during an on-demand poll is polled
+    again right away. Given scrape_ttl, only polls while unsettled include
+    status, and given stream none do; the others are config checks.
+    """
+    await asyncio.sleep(random.uniform(0, self._jitter))
+    wake = self._wake[router]
+    deadline = time.monotonic()
+    config_t = -math.inf  # check config right away
+    while True:
+      inflight, unused_status = self._inflight.get(router, (None, False))
+      if inflight:  # an on-demand poll; it may not check the config
+        await asyncio.wait([inflight])
+      now = time.monotonic()
+      status = not self._stream and (self._scrapeTtl is None or self._fast(router))
+      config = not status or now - config_t >= self._configInterval
+      if config:
+        config_t = now
+      await self._start(router, config=config, status=status)
+      wake.clear()  # this poll's own findings are in _interval() already
+      interval = self._interval(router)
+      now = time.monotonic()
+      deadline += interval
+      if deadline < now:
+        deadline += math.ceil((now - deadline) / interval) * interval
+      logging.debug('%s: sleep(%.1f)', router, deadline - now)
+      try:
+        await asyncio.wait_for(wake.wait(), deadline - now)
+        deadline = time.monotonic()
+      except asyncio.TimeoutError:
+        pass
+
+  async def _streamSession(self, router, stream):
+    """Run one stream session to router until it ends or goes quiet.
+
+    Raises asyncio.TimeoutError when no complete status arrives for
+    self._timeout seconds past when it was due.
+    """
+    conn = self._conns[router]
+
+    def killed(unused_sig):
+      METRICS['kills'].labels(stage='stream', router=router).inc()
+
+    await self._throttle(router)
+    try:
+      await self._prepare(conn, self._timeout)
+    except asyncio.TimeoutError:
+      METRICS['timeouts'].labels(stage='connect', router=router).inc()
+      raise
+    proc = await asyncio.create_subprocess_exec(
+        *conn.Command(stream.Command()),
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=_LINE_LIMIT,
+        start_new_session=True)
+    err = asyncio.create_task(_drain(proc.stderr))
+    deadline = time.monotonic() + self._stream + self._timeout
+    try:
+      while True:
+        raw = await asyncio.wait_for(proc.stdout.readline(), max(0, deadline - time.monotonic()))
+        if not raw:
+          break
+        if raw.endswith(b'\n'):
+          raw = raw[:-1]
+        batch = stream.Feed(raw.decode('utf-8'))
+        if batch:
+          _observeBatch(router, batch, None)
+          deadline = time.monotonic() + self._stream + self._timeout
+      returncode = await asyncio.wait_for(proc.wait(), self._timeout)
+      stderr = await asyncio.wait_for(err, self._timeout)
+    except BaseException as e:  # timeout and cancellation alike
+      if isinstance(e, asyncio.TimeoutError):
+        METRICS['timeouts'].labels(stage='stream', router=router).inc()
+      await asyncio.shield(_reap(proc, killed=killed))
+      raise
+    finally:
+      err.cancel()
+    logging.error('%s: status stream ended, exit %s: %s', router, returncode,
+                  stderr.decode('utf-8', 'replace'))
+
+  async def _streamForever(self, router):
+    """Keep a stream session to router going, restarting it with backoff."""
+    backoff = 1
+    while True:
+      stream = poll.StatusStream(self._conns[router], self._stream,
+                                 lambda lines, section: self._statusDone(router, lines, section))
+      started = time.monotonic()
+      try:
+        await self._streamSession(router, stream)
+      except asyncio.TimeoutError:
+        logging.error('%s: status stream silent for %ss past due, restarting', router, self._timeout)
+      except Exception:
+        logging.exception('%s: status stream failed', router)
+      if stream.frames and time.monotonic() - started > 60:
+        backoff = 1  # it worked for a while
+      delay = backoff * random.uniform(0.5, 1)
+      logging.info('%s: restarting status stream in %.1fs', router, delay)
+      await asyncio.sleep(delay)
+      backoff = min(backoff * 2, 300)
+
+  async def refresh(self, ttl):
+    """Poll the status of every router whose newest is older than ttl seconds."""
+    now = time.monotonic()
+    tasks = [self._start(router) for router in self._conns
+             if now - self._polled.get(router, -math.inf) > ttl]
+    if tasks:
+      await asyncio.wait(tasks)
+
+  def scrape(self, wait):
+    """Called from a scrape's thread: refresh(scrape_ttl) on the engine's loop.
+
+    Gives up after wait seconds, leaving the polls running; the scrape then
+    gets the status as it was, and the next one the polls' results.
+    """
+    if self._loop is None:
       return
-    new_dirfn = os.path.join(self._logdir, '%04d' % dt.year, new_fn)
-    with open(new_dirfn, 'w') as fh:
-      fh.write(new_config)
-    new_yearfn = os.path.join('%04d' % dt.year, new_fn)
+    future = asyncio.run_coroutine_threadsafe(self.refresh(self._scrapeTtl), self._loop)
     try:
-      os.symlink(new_yearfn, latest_fn)
-    except FileExistsError:
-      os.unlink(latest_fn)
-      os.symlink(new_yearfn, latest_fn)
-    logging.debug('Archiver.run end')
-
-
-def _publishMetrics(name, labels, allowed, status, uninitializedMetrics):
-  if uninitializedMetrics:
-    for state in allowed:
-      labels['is'] = state
-      METRICS[name].labels(**labels).set(-2)
-  if status not in allowed:
-    logging.error('ERR: unknown status=%s on %s', status, labels)
-    for state in allowed:
-      labels['is'] = state
-      METRICS[name].labels(**labels).set(-1)  # is there a undefined instead? or publish nothing?
-  else:
-    for state in allowed:
-      labels['is'] = state
-      if status == state:
-        METRICS[name].labels(**labels).set(1)
-      else:
-        METRICS[name].labels(**labels).set(0)
-  logging.debug('publish %s %s', name, labels)
+      future.result(wait)
+    except concurrent.futures.TimeoutError:
+      logging.warning('scrape: status polls still running after %ss, serving older status', wait)
+
+  async def run(self):
+    """Poll every router until cancelled."""
+    self._loop = asyncio.get_running_loop()
+    tasks = [asyncio.create_task(self._schedule(router)) for router in self._conns]
+    if self._stream:
+      tasks.extend(asyncio.create_task(self._streamForever(router)) for router in self._conns)
+    try:
+      await asyncio.gather(*tasks)
+    finally:
+      self._loop = None
+      tasks.extend(task for task, unused_status in self._inflight.values())
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+      self._setup.shutdown(wait=False)
+
+
+def _observeBatch(router, batch, start):
+  """Record the timings, exit codes and stderr of batch's finished sections.
+
+  start is the time.monotonic() the ssh command was started, None for no
+  connect time.
+  """
+  if start is not None and batch.firstLine is not None:
+    METRICS['poll_seconds'].labels(stage='connect', router=router).observe(batch.firstLine - start)
+  for section in batch:
+    if section.ended is None:
+      continue
+    METRICS['poll_seconds'].labels(stage=section.name, router=router).observe(section.ended - section.started)
+    METRICS['poll_parse_seconds'].labels(stage=section.name, router=router).observe(section.parseSeconds)
+    if section.returncode:
+      METRICS['nonzero_exits'].labels(stage=section.name, router=router).inc()
+    if section.err:
+      METRICS['stderr'].labels(stage=section.name, router=router).inc()
+      logging.warning('%s: %s stderr: %s', router, ' '.join(section.cmd), section.err)
+
+
+def _publishTransition(router, transition):
+  """Count and log a poll.Transition."""
+  labels = {'router': router, 'group': transition.group, 'interface': transition.interface,
+            'event': transition.kind}
+  METRICS['transitions'].labels(**labels).inc()
+  METRICS['last_transition'].labels(**labels).set_to_current_time()
+  logging.warning('%s: %s group=%s interface=%s %s -> %s', router, *transition)
+
+
+def _checkLoadBalance(router, load_balance):
+  """Log interfaces whose reachable or status LoadBalanceCollector can't render."""
+  for g in load_balance.groups:
+    for interface in g.interfaces:
+      for name, (unused_doc, allowed) in LoadBalanceCollector.METRICS.items():
+        value = getattr(interface, name)
+        if value not in allowed:
+          logging.error('ERR: unknown %s=%s on router=%s group=%s interface=%s',
+                        name, value, router, g.name, interface.name)
+
+
+def _readRouters(fn):
+  """Read router addresses from fn; one per line, # starts a comment."""
+  routers = []
+  with open(fn, 'r') as fh:
+    for line in fh:
+      line = line.split('#', 1)[0].strip()
+      if line:
+        routers.append(line)
+  return routers
 
 
 if __name__ == '__main__':
@@ -142,52 +761,87 @@ if __name__ == '__main__':
   # new hotness: ip route show default -> "default via 10.0.0.1 dev en0 proto static\n"
   # N.B.: multiple network interfaces (i.e. ethernet and wifi) causes multiple lines returned
   parser = argparse.ArgumentParser(description='Extract edgerouter status')
-  parser.add_argument('--ip', default='EdgeRouterScraper', help='IP address of the router; default=EdgeRouterScraper')
+  parser.add_argument('--ip', action='append', default=[],
+                      help='IP address of a router, may be repeated; default=EdgeRouterScraper')
+  parser.add_argument('--routers', help='file listing router addresses, one per line')
+  parser.add_argument('--multiplex', action='store_true',
+                      help='keep one ssh session open and run every command over it')
+  parser.add_argument('--fake', metavar='RECORDING',
+                      help='poll local replays of a fakerouter.py recording instead of ssh')
+  parser.add_argument('--logdir', default='Logs/', help='config archive; default=Logs/')
+  parser.add_argument('--timeout', type=float, default=50,
+                      help='seconds each router gets to answer a poll; default=50')
+  parser.add_argument('--jitter', type=float, default=5,
+                      help='spread poll start times over this many seconds; default=5')
+  parser.add_argument('--status-interval', type=float, default=60,
+                      help='seconds between load-balance polls while all is well; default=60')
+  parser.add_argument('--config-interval', type=float, default=60,
+                      help='seconds between config change checks, rounded up to a status poll; default=60')
+  parser.add_argument('--compress-over', type=int, default=32768,
+                      help='gzip configs larger than this many bytes in transit; default=32768')
+  parser.add_argument('--scrape-ttl', type=float,
+                      help='poll load-balance status when a scrape finds it older than this many seconds,'
+                      ' instead of every --status-interval')
+  parser.add_argument('--scrape-wait', type=float, default=5,
+                      help='seconds a scrape waits for those polls before serving older status; default=5')
+  parser.add_argument('--fast-interval', type=float, default=5,
+                      help='seconds between polls while an interface is down, inactive or changing,'
+                      ' 0 for never; default=5')
+  parser.add_argument('--max-calls', type=int, default=20,
+                      help='most ssh sessions per router and minute, 0 for no limit; default=20')
+  parser.add_argument('--stream', type=float,
+                      help='get load-balance status every this many seconds over one long-lived ssh session'
+                      ' per router, instead of polling')
+  parser.add_argument('--flow-samples', type=int, default=1440,
+                      help='flow counter samples kept per interface for /flows, at least 1; default=1440')
   args = parser.parse_args()
+  if args.flow_samples < 1:
+    parser.error('--flow-samples must be at least 1')
+
+  routers = list(args.ip)
+  if args.routers:
+    routers.extend(_readRouters(args.routers))
+  if not routers:
+    routers = ['EdgeRouterScraper']
+
+  # Each router's status and config polls share its connection, and with
+  # --multiplex the session it holds open.
+  conns = {}
+  for router in routers:
+    if args.fake:
+      conns[router] = fakerouter.FakeRouter(fakerouter.Recording(args.fake))
+    elif args.multiplex:
+      conns[router] = poll.MultiplexedSshConnection(router)
+    else:
+      conns[router] = poll.SshConnection(router)
 
-  # check the config at intervals
-  config_t = 0  # check config right away
+  flows = flowring.FlowHistory(args.flow_samples)
+  engine = Engine(conns, args.logdir, timeout=args.timeout, jitter=args.jitter,
+                  status_interval=args.status_interval,
+                  config_interval=args.config_interval,
+                  compress_over=args.compress_over,
+                  scrape_ttl=args.scrape_ttl,
+                  flows=flows,
+                  fast_interval=args.fast_interval,
+                  max_calls=args.max_calls,
+                  stream=args.stream)
+  if args.scrape_ttl is not None:
+    COLLECTOR.refresh = lambda: engine.scrape(args.scrape_wait)
 
   # Start up the server to expose the metrics.
-  uninitializedMetrics = True
-  prometheus_client.start_http_server(8000)
+  serve(8000, flows)
   logging.debug('Started prometheus stats publishing on :8000')
-  # Generate some requests.
-  while True:
-    t = Processor(args.ip)
-    t.start()
-    now = time.time()
-    if now - config_t > 3600:
-      tc = Archiver(args.ip, 'Logs/')
-      tc.start()
-      tc.join(timeout=30)
-      if tc.is_alive():
-        tc.kill()
-      else:
-        logging.debug('Archiver success')
-      config_t = now
-    t.join(timeout=50)
-    if t.is_alive():
-      t.kill()
-    else:
-      # TODO: productionize _d; stop being a private
-      #print(t.load_balance._d)
-      logging.debug('Processor success, harvesting data')
-      for g in t.load_balance._d._groups:
-        for interface in g._interfaces:
-          labels = {'group':g._name, 'interface':interface._name}
-          _publishMetrics(
-              'reachable', labels,
-              ('true', 'false'), interface._reachable,
-              uninitializedMetrics)
-          labels = {'group':g._name, 'interface':interface._name}
-          _publishMetrics(
-              'status', labels,
-              ('active', 'inactive', 'failover'), interface._status,
-              uninitializedMetrics)
-          uninitializedMetrics = False
-
-    remainder = 60 - (time.time() % 60)
-    logging.debug('sleep(%s)', int(remainder))
-    #time.sleep(5)
-    time.sleep(remainder)
+
+  async def _main():
+    task = asyncio.create_task(engine.run())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+      loop.add_signal_handler(sig, task.cancel)
+    try:
+      await task
+    except asyncio.CancelledError:
+      logging.info('shutting down')
+    for conn in conns.values():
+      conn.Close()
+
+  asyncio.run(_main())
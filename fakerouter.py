@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+"""A stand-in for an EdgeRouter: replays recorded outputs with local sh.
+
+A recording is a directory holding what a router said, one file per poll:
+
+  RECORDING/wlbGetStatus/1, 2, ...   /usr/sbin/ubnt-hal wlbGetStatus outputs
+  RECORDING/config.boot/1, 2, ...    /config/config.boot versions
+
+FakeRouter is a poll.Transport that runs the commands every poller sends
+with local sh, the router's paths pointed into the recording. Each status
+poll gets the next output, each config fetch the next version, both
+starting over after the last. Faults are drawn per session: connect
+latency, a status command that hangs, a session cut off partway, a status
+command exiting non-zero.
+
+  ./fakerouter.py record EdgeRouterScraper Recordings/EdgeRouterScraper --polls 10
+  ./fakerouter.py replay Recordings/EdgeRouterScraper --hang 0.1
+  ./daemon.py --fake Recordings/EdgeRouterScraper --ip r1 --ip r2
+"""
+
+import argparse
+import os
+import random
+import shlex
+import sys
+import time
+
+import poll
+
+
+STATUS = 'wlbGetStatus'
+CONFIG = 'config.boot'
+
+_STATUS_COMMAND = ' '.join(poll.ShowLoadBalanceStatus.COMMAND)
+
+
+class Error(Exception):
+  """Do not raise. Package level exception."""
+
+
+class Recording(object):
+  """Outputs recorded from one router, see the module docstring."""
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.statuses = self._count(STATUS)
+    self.configs = self._count(CONFIG)
+
+  def _count(self, name):
+    """Number of outputs in name/, which must be 1..N."""
+    try:
+      files = os.listdir(os.path.join(self.directory, name))
+    except FileNotFoundError:
+      raise Error('%s: no %s/' % (self.directory, name))
+    n = len(files)
+    if not n or sorted(files) != sorted(str(i) for i in range(1, n + 1)):
+      raise Error('%s/%s: want files 1 to N, got %s' % (self.directory, name, sorted(files)[:5]))
+    return n
+
+  def path(self, name, i):
+    """File of output i (1-based) of name."""
+    return os.path.join(self.directory, name, str(i))
+
+  @staticmethod
+  def write(directory, statuses, configs):
+    """Create a recording of statuses and configs (bytes each)."""
+    for name, outputs in ((STATUS, statuses), (CONFIG, configs)):
+      os.makedirs(os.path.join(directory, name), exist_ok=True)
+      for i, out in enumerate(outputs, 1):
+        with open(os.path.join(directory, name, str(i)), 'wb') as fh:
+          fh.write(out)
+    return Recording(directory)
+
+
+class FakeRouter(poll.Transport):
+  """Replays a Recording; faults are probabilities per session.
+
+  latency  seconds before the session says anything, like ssh's handshake
+  hang     the status command never returns
+  truncate the session dies partway through its output, exit 255 like ssh
+  fail     the status command exits 1 with a message on stderr
+  """
+
+  def __init__(self, recording, latency=0, hang=0, truncate=0, fail=0, seed=None):
+    self._recording = recording
+    self._latency = latency
+    self._faults = (('hang', hang), ('truncate', truncate), ('fail', fail))
+    self._random = random.Random(seed)
+    self._status = 0  # outputs replayed so far
+    self._config = 0
+    self.sessions = 0
+
+  def _statusCommand(self, fault):
+    """sh replacing wlbGetStatus. $i picks the output; it lives on across
+    the iterations of a StatusStream loop, so each gets the next one.
+    """
+    n = self._recording.statuses
+    cat = 'i=$((${i:-%d} %% %d + 1)); cat %s/$i' % (
+        self._status, n, shlex.quote(os.path.join(self._recording.directory, STATUS)))
+    self._status = self._status % n + 1
+    if fault == 'hang':
+      return 'sleep 86400'
+    if fault == 'fail':
+      return "(%s >/dev/null; echo 'wlbGetStatus: fake failure' >&2; exit 1)" % cat
+    return cat
+
+  def Command(self, cmd):
+    """Returns sh running cmd against the recording."""
+    self.sessions += 1
+    fault = None
+    for name, p in self._faults:
+      if self._random.random() < p:
+        fault = name
+        break
+    script = ' '.join(cmd)
+    if poll.ShowConfig.PATH in script:
+      self._config = self._config % self._recording.configs + 1
+      script = script.replace(poll.ShowConfig.PATH,
+                              shlex.quote(self._recording.path(CONFIG, self._config)))
+    if _STATUS_COMMAND in script:
+      script = script.replace(_STATUS_COMMAND, self._statusCommand(fault))
+    if self._latency:
+      script = 'sleep %g; %s' % (self._latency, script)
+    if fault == 'truncate':
+      size = os.path.getsize(self._recording.path(STATUS, 1))
+      script = '{ %s; } | head -c %d; exit 255' % (script, self._random.randrange(size))
+    return ['sh', '-c', script]
+
+
+def record(args):
+  """Save --polls outputs of a real router, --interval seconds apart."""
+  conn = poll.SshConnection(args.ip)
+  statuses = []
+  for i in range(args.polls):
+    if i:
+      time.sleep(args.interval)
+    out, err = conn.Run(poll.ShowLoadBalanceStatus.COMMAND)
+    if err:
+      print('wlbGetStatus: %s' % err.decode('utf-8', 'replace'), file=sys.stderr)
+    statuses.append(out)
+  config, err = conn.Run(poll.ShowConfig.COMMAND)
+  if err:
+    raise Error('%s: %s' % (poll.ShowConfig.PATH, err.decode('utf-8', 'replace')))
+  Recording.write(args.recording, statuses, [config])
+  print('%d statuses and a config in %s' % (args.polls, args.recording))
+
+
+def replay(args):
+  """Poll the fake once with a Batch, as the daemon would, and print it."""
+  conn = FakeRouter(Recording(args.recording), latency=args.latency, hang=args.hang,
+                    truncate=args.truncate, fail=args.fail, seed=args.seed)
+  lb = poll.ShowLoadBalanceStatus(conn)
+  conf = poll.ShowConfig(conn, unless_md5='', compress_over=32768)
+  batch = poll.Batch(conn)
+  batch.Add('status', lb.COMMAND, lb.Feed)
+  batch.Add('config', conf.COMMAND, conf.Feed, conf.End)
+  batch.Run()
+  for name in ('status', 'config'):
+    section = batch[name]
+    print('%s: exit %s %s' % (name, section.returncode, section.err or ''))
+  print(lb.status)
+  print('config: %d bytes, md5 %s' % (len(str(conf)), conf.md5))
+
+
+def main(argv):
+  """Main."""
+  parser = argparse.ArgumentParser(description='Record a router, or replay a recording locally')
+  sub = parser.add_subparsers(dest='command', required=True)
+  p = sub.add_parser('record', help='save status outputs and the config of a real router')
+  p.add_argument('ip', help='ssh destination, e.g. EdgeRouterScraper')
+  p.add_argument('recording', help='directory to write')
+  p.add_argument('--polls', type=int, default=10, help='status outputs to save; default=10')
+  p.add_argument('--interval', type=float, default=60, help='seconds between them; default=60')
+  p.set_defaults(func=record)
+  p = sub.add_parser('replay', help='poll a recording once and print what came back')
+  p.add_argument('recording')
+  p.add_argument('--latency', type=float, default=0, help='seconds before any output')
+  p.add_argument('--hang', type=float, default=0, help='probability the status command hangs, for good here')
+  p.add_argument('--truncate', type=float, default=0, help='probability output is cut off')
+  p.add_argument('--fail', type=float, default=0, help='probability the status command fails')
+  p.add_argument('--seed', type=int, help='random seed for the faults')
+  p.set_defaults(func=replay)
+  args = parser.parse_args(argv[1:])
+  args.func(args)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+"""Recent load-balance flow counters of every interface, in fixed memory.
+
+Each status poll appends every interface's flow counters to its FlowRing,
+which keeps the newest samples in arrays allocated up front: memory
+depends on the ring size and the number of interfaces, never on uptime.
+The daemon serves them as JSON, with per-second rates between consecutive
+samples, next to its metrics:
+
+  curl -s localhost:8000/flows
+  curl -s 'localhost:8000/flows?router=EdgeRouterScraper'
+"""
+
+import array
+import json
+import threading
+import urllib.parse
+
+import poll
+
+
+NAMES = poll.LoadBalanceGroupInterfaceFlows.NAMES
+_MISSING = -1  # stored for a counter the router didn't report
+
+
+class FlowRing(object):
+  """The newest size samples of one interface's flow counters."""
+
+  def __init__(self, size):
+    self._size = size
+    self._times = array.array('d', bytes(8 * size))
+    self._counts = array.array('q', bytes(8 * size * len(NAMES)))  # size rows of len(NAMES)
+    self._next = 0  # row the next sample goes into
+    self._len = 0
+
+  def __len__(self):
+    return self._len
+
+  def append(self, when, counts):
+    """Add a sample: when in seconds since the epoch, counts in NAMES order."""
+    i = self._next
+    n = len(NAMES)
+    self._times[i] = when
+    self._counts[i * n:(i + 1) * n] = array.array('q', (_MISSING if c is None else c for c in counts))
+    self._next = (i + 1) % self._size
+    self._len = min(self._len + 1, self._size)
+
+  def samples(self):
+    """Returns [(when, counts)] oldest first; None for unreported counts."""
+    n = len(NAMES)
+    first = (self._next - self._len) % self._size
+    samples = []
+    for k in range(self._len):
+      i = (first + k) % self._size
+      counts = tuple(None if c == _MISSING else c for c in self._counts[i * n:(i + 1) * n])
+      samples.append((self._times[i], counts))
+    return samples
+
+
+def rates(samples):
+  """Returns [(when, per-second rates)] between consecutive samples.
+
+  A rate is None where either count is missing or the counter went down,
+  as it does when the router restarts.
+  """
+  retval = []
+  for (t0, c0), (t1, c1) in zip(samples, samples[1:]):
+    if t1 <= t0:
+      continue
+    retval.append((t1, tuple(
+        None if a is None or b is None or b < a else (b - a) / (t1 - t0) for a, b in zip(c0, c1))))
+  return retval
+
+
+class FlowHistory(object):
+  """FlowRings of every (router, group, interface) currently reported.
+
+  Written by the poller, read by web requests on other threads.
+  """
+
+  def __init__(self, size=1440):
+    self._size = size
+    self._rings = {}  # (router, group, interface) -> FlowRing
+    self._lock = threading.Lock()
+
+  def add(self, router, load_balance, when):
+    """Append the flow counters of every interface of a poll.LoadBalance.
+
+    Interfaces of router that it doesn't list any more are forgotten.
+    """
+    with self._lock:
+      seen = set()
+      for g in load_balance.groups:
+        for interface in g.interfaces:
+          if interface.flows is None:
+            continue
+          key = (router, g.name, interface.name)
+          seen.add(key)
+          ring = self._rings.get(key)
+          if ring is None:
+            ring = self._rings[key] = FlowRing(self._size)
+          ring.append(when, interface.flows.counts())
+      for key in [k for k in self._rings if k[0] == router and k not in seen]:
+        del self._rings[key]
+
+  def snapshot(self, router=None):
+    """Returns the JSON-able history, of one router or all of them."""
+    with self._lock:
+      rings = [(key, ring.samples()) for key, ring in sorted(self._rings.items())
+               if router is None or key[0] == router]
+    interfaces = []
+    for (r, group, interface), samples in rings:
+      interfaces.append({
+          'router': r, 'group': group, 'interface': interface,
+          'samples': [[when] + list(counts) for when, counts in samples],
+          'rates': [[when] + list(per_second) for when, per_second in rates(samples)],
+      })
+    return {'names': list(NAMES), 'interfaces': interfaces}
+
+  def wsgi(self, environ, start_response):
+    """WSGI application serving snapshot(); ?router= picks one router."""
+    query = urllib.parse.parse_qs(environ.get('QUERY_STRING', ''))
+    body = json.dumps(self.snapshot(query.get('router', [None])[0])).encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'application/json'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+"""When did a config setting change? Path index over an archive.Store.
+
+Every archived config is flattened with configdiff into paths, the chain of
+section names plus the entry key, e.g.
+
+  firewall name WAN_IN rule 5003 action
+  interfaces ethernet eth2 address
+
+The index maps each path to the versions where its value changed, with the
+new value (None once removed). It lives next to the store as an append-only
+file of one JSON line per indexed version, holding only the paths that
+changed, so keeping it current costs one parse per new version and queries
+never touch the archive itself.
+
+  ./history.py Logs/EdgeRouterScraper firewall name WAN_IN rule 5003
+  ./history.py Logs/EdgeRouterScraper --last interfaces ethernet eth2 address
+"""
+
+import argparse
+import bisect
+import datetime
+import json
+import logging
+import os
+import sys
+
+import archive
+import configdiff
+
+
+class AlreadyIndexedError(archive.Error):
+  """The version is in the index already."""
+
+
+def flatten(text, cache=None):
+  """Returns {path: value} for config text.
+
+  value is the entry's values one per line; bare keywords have value ''.
+  Parses through cache, a configdiff.ParseCache, if given.
+  """
+  if cache is None:
+    config = configdiff.parse(text)
+  else:
+    config = cache.parse(text.encode('utf-8'))
+  paths = {}
+  for path, entries in config.walk():
+    paths[' '.join(path)] = '\n'.join(v or '' for v in entries.keys())
+  return paths
+
+
+class PathIndex(object):
+  """Path -> [(version, value)] for one store directory."""
+
+  FILENAME = 'paths'
+
+  def __init__(self, directory, cache=None):
+    self._fn = os.path.join(directory, self.FILENAME)
+    self._cache = cache
+    self._history = {}
+    self._current = {}  # path -> value as of self.version, removed paths omitted
+    self._sorted = None
+    self._size = 0  # bytes of whole records; anything after is a torn write
+    self.version = 0
+    try:
+      with open(self._fn, 'rb') as fh:
+        data = fh.read()
+    except FileNotFoundError:
+      return
+    for line in data.splitlines(keepends=True):
+      if not line.endswith(b'\n'):
+        break
+      try:
+        record = json.loads(line)
+      except ValueError:
+        break
+      self._apply(record['version'], record['changes'])
+      self._size += len(line)
+
+  def _apply(self, version, changes):
+    for path, value in changes.items():
+      self._history.setdefault(path, []).append((version, value))
+      if value is None:
+        self._current.pop(path, None)
+      else:
+        self._current[path] = value
+    self.version = version
+    self._sorted = None
+
+  def add(self, version, text):
+    """Index text as the given version; returns the paths that changed."""
+    if version <= self.version:
+      raise AlreadyIndexedError('version %d already indexed' % version)
+    paths = flatten(text, self._cache)
+    changes = {}
+    for path, value in paths.items():
+      if self._current.get(path) != value:
+        changes[path] = value
+    for path in self._current:
+      if path not in paths:
+        changes[path] = None
+    self._append(version, changes)
+    return sorted(changes)
+
+  def _append(self, version, changes):
+    """Write the record of version and apply it."""
+    line = json.dumps({'version': version, 'changes': changes},
+                      separators=(',', ':')).encode('utf-8') + b'\n'
+    with open(self._fn, 'ab') as fh:
+      fh.truncate(self._size)
+      fh.write(line)
+      fh.flush()
+      os.fsync(fh.fileno())
+    self._size += len(line)
+    self._apply(version, changes)
+
+  def update(self, store):
+    """Index every version of store not indexed yet.
+
+    A version that doesn't parse is indexed as changing nothing, so the
+    ones after it still get indexed; its changes show up with the next
+    version that parses.
+    """
+    for version in range(self.version + 1, store.version + 1):
+      try:
+        self.add(version, store.get(version))
+      except configdiff.ParseError as e:
+        logging.warning('%s: version %d does not parse, indexed as unchanged: %s',
+                        self._fn, version, e)
+        self._append(version, {})
+
+  def paths(self):
+    """All paths ever seen, sorted."""
+    if self._sorted is None:
+      self._sorted = sorted(self._history)
+    return self._sorted
+
+  def query(self, prefix):
+    """Yield (path, [(version, value)]) for prefix and every path below it."""
+    paths = self.paths()
+    i = bisect.bisect_left(paths, prefix)
+    while i < len(paths) and paths[i].startswith(prefix):
+      path = paths[i]
+      if len(path) == len(prefix) or path[len(prefix)] == ' ' or not prefix:
+        yield path, self._history[path]
+      i += 1
+
+
+def main(argv):
+  """Main."""
+  parser = argparse.ArgumentParser(description='Config history by path')
+  parser.add_argument('store', help='store directory, e.g. Logs/EdgeRouterScraper')
+  parser.add_argument('--last', action='store_true', help='only the most recent change of each path')
+  parser.add_argument('path', nargs='*', help='path prefix, e.g. firewall name WAN_IN rule 5003')
+  args = parser.parse_intermixed_args(argv[1:])
+
+  store = archive.Store(args.store)
+  index = PathIndex(args.store, cache=configdiff.ParseCache())
+  index.update(store)  # normally a no-op; the daemon indexes as it archives
+  for path, changes in index.query(' '.join(args.path)):
+    if args.last:
+      changes = changes[-1:]
+    print(path)
+    for version, value in changes:
+      when = datetime.datetime.fromtimestamp(store.timestamp(version)).isoformat(' ', 'seconds')
+      if value is None:
+        value = '(removed)'
+      print('  %6d  %s  %s' % (version, when, value.replace('\n', ' | ')))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
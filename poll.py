@@ -1,20 +1,121 @@
 #!/usr/bin/python3
 
+import abc
+import binascii
+import codecs
+import collections
+import hashlib
 import os
 import re
+import signal
+import socket
+import stat
 import subprocess
 import sys
+import threading
+import time
+import zlib
 
-class SshConnection(object):
 
-  def __init__(self, addr):
-    self._addr = addr
+class Error(Exception):
+  """Do not raise. Package level exception."""
+
+
+class UnsafeControlDirError(Error):
+  """The ssh control socket directory could be written by someone else."""
+
+
+class RemoteCommand(object):
+  """A running command. Iterate over it for stdout, one line at a time.
+
+  stderr is drained on its own thread so a chatty command can never block
+  on a full pipe; the first STDERR_LIMIT bytes are kept in .err. Leaving the
+  iteration early (or close()) kills the command.
+  """
+
+  STDERR_LIMIT = 64 * 1024
+
+  def __init__(self, command, callback=None):
+    # own session, so close() can take down anything the command forked.
+    self._h = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
+                               start_new_session=True)
+    if callback:
+      callback(self._h.pid)
+    self._err = []
+    self._errThread = threading.Thread(target=self._drain, daemon=True)
+    self._errThread.start()
+    self.returncode = None
+
+  def _drain(self):
+    kept = 0
+    for chunk in iter(lambda: self._h.stderr.read(4096), b''):
+      if kept < self.STDERR_LIMIT:
+        self._err.append(chunk[:self.STDERR_LIMIT - kept])
+        kept += len(chunk)
+
+  def __iter__(self):
+    for raw in self._h.stdout:
+      if raw.endswith(b'\n'):
+        raw = raw[:-1]
+      yield raw.decode('utf-8')
+
+  @property
+  def err(self):
+    """stderr so far (bytes)."""
+    return b''.join(self._err)
+
+  def _exited(self, timeout):
+    """Wait up to timeout seconds for the command to exit, without reaping
+    it. Returns True if it did.
+    """
+    deadline = time.monotonic() + timeout
+    while os.waitid(os.P_PID, self._h.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None:
+      if time.monotonic() >= deadline:
+        return False
+      time.sleep(0.01)
+    return True
+
+  def close(self):
+    """Stop reading, kill the command if still running, reap it."""
+    if self._h.returncode is None:
+      self._h.stdout.close()  # a writer blocked on a full pipe gets SIGPIPE
+      self._exited(1)
+      # Until it is reaped its pid, and so the process group id, can't be
+      # reused: only the command and whatever it forked get the signal.
+      try:
+        os.killpg(self._h.pid, signal.SIGKILL)  # stragglers holding stderr open
+      except ProcessLookupError:
+        pass
+    self.returncode = self._h.wait()
+    self._errThread.join()
+    self._h.stdout.close()
+    self._h.stderr.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused):
+    self.close()
+
+
+class Transport(abc.ABC):
+  """How commands reach a router: as a local argv, see Command().
+
+  Everything that polls a router, Batch, StatusStream and the daemon's
+  Engine alike, only runs what Command() returns, so a subclass decides
+  what runs there: ssh, or e.g. fakerouter.FakeRouter's local replay.
+  """
+
+  def Prepare(self):
+    """Get ready to run commands. May block; call before Command()."""
+
+  @abc.abstractmethod
+  def Command(self, cmd):
+    """Returns the local argv that runs cmd on the router."""
 
   def Run(self, cmd, callback=None):
-    command = ['/usr/bin/ssh',
-               '-o', 'NumberOfPasswordPrompts=0',  # never prompt for a password when ssh with key fails.
-               '-n', self._addr]
-    command.extend(cmd)
+    self.Prepare()
+    command = self.Command(cmd)
     h = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
     if callback:
       callback(h.pid)
@@ -25,12 +126,320 @@ class SshConnection(object):
 #      print('===== end stderr =====')
     return out, err
 
+  def Stream(self, cmd, callback=None):
+    """Start cmd; returns a RemoteCommand yielding stdout lines as they arrive."""
+    self.Prepare()
+    return RemoteCommand(self.Command(cmd), callback=callback)
+
+  def Close(self):
+    """Release the connection. Nothing to do; every Run() is standalone."""
+
+
+class SshConnection(Transport):
+
+  def __init__(self, addr):
+    self._addr = addr
+
+  def _sshOptions(self):
+    """Options inserted between /usr/bin/ssh and the destination."""
+    return ['-o', 'NumberOfPasswordPrompts=0']  # never prompt for a password when ssh with key fails.
+
+  def Command(self, cmd):
+    """Returns the local argv that runs cmd on the router."""
+    command = ['/usr/bin/ssh']
+    command.extend(self._sshOptions())
+    command.extend(['-n', self._addr])
+    command.extend(cmd)
+    return command
+
+
+class MultiplexedSshConnection(SshConnection):
+  """Run every command over one persistent, authenticated ssh session.
+
+  The first Prepare() starts an OpenSSH control master in the background; later
+  commands attach to its socket and skip the TCP and key exchange. If the
+  master dies (router reboot, network flap) the next Prepare() starts a new one.
+  One instance may be shared between threads.
+
+  The sockets live in control_dir, by default under $XDG_RUNTIME_DIR or
+  else ~/.ssh. Whoever can write there could plant a socket of their own
+  and answer our polls, so the directory must be ours alone: a real
+  directory, owned by us, mode 0700. UnsafeControlDirError otherwise.
+  """
+
+  def __init__(self, addr, control_dir=None):
+    super().__init__(addr)
+    if control_dir is None:
+      control_dir = os.path.join(
+          os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser('~/.ssh'), 'edgerouter-ssh')
+    os.makedirs(control_dir, mode=0o700, exist_ok=True)
+    st = os.lstat(control_dir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+      raise UnsafeControlDirError('%s: want a directory of uid %d with mode 0700, got uid %d mode %03o' % (
+          control_dir, os.getuid(), st.st_uid, stat.S_IMODE(st.st_mode)))
+    # unix socket paths are limited to ~100 bytes; don't use the raw address.
+    name = hashlib.sha1(addr.encode('utf-8')).hexdigest()[:16]
+    self._controlPath = os.path.join(control_dir, name)
+    self._lock = threading.Lock()
+
+  def _sshOptions(self):
+    options = super()._sshOptions()
+    options.extend(['-o', 'ControlMaster=no',
+                    '-o', 'ControlPath=%s' % self._controlPath])
+    return options
+
+  def _masterAlive(self):
+    """True if a control master is listening on our socket."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      s.connect(self._controlPath)
+    except FileNotFoundError:
+      return False
+    except ConnectionRefusedError:
+      # master was killed without cleaning up after itself.
+      os.unlink(self._controlPath)
+      return False
+    finally:
+      s.close()
+    return True
+
+  def Prepare(self):
+    """Start the control master unless one is already running."""
+    with self._lock:
+      if self._masterAlive():
+        return
+      command = ['/usr/bin/ssh',
+                 '-o', 'NumberOfPasswordPrompts=0',
+                 '-o', 'ConnectTimeout=10',
+                 # let the master notice a dead link and exit so we reconnect.
+                 '-o', 'ServerAliveInterval=15',
+                 '-o', 'ServerAliveCountMax=3',
+                 '-o', 'ControlMaster=yes',
+                 '-o', 'ControlPath=%s' % self._controlPath,
+                 '-N', '-f', self._addr]
+      # -f forks after authentication; the background master must not hold
+      # on to our pipes.
+      try:
+        subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, timeout=30)
+      except subprocess.TimeoutExpired:
+        pass  # ssh falls back to a direct connection when the socket is missing.
+
+  def Close(self):
+    """Stop the control master."""
+    subprocess.run(['/usr/bin/ssh', '-o', 'ControlPath=%s' % self._controlPath,
+                    '-O', 'exit', self._addr],
+                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+
+class BatchSection(object):
+  """One command of a Batch, with its exit status and stderr once it ends.
+
+  started and ended are the time.monotonic() of its start and end markers,
+  None until they arrive; parseSeconds is the time spent in feed().
+  """
+
+  def __init__(self, name, cmd, feed, end):
+    self.name = name
+    self.cmd = cmd
+    self.feed = feed
+    self.end = end
+    self.returncode = None  # None until the section's end marker arrives
+    self.started = None
+    self.ended = None
+    self.parseSeconds = 0.0
+    self._err = []
+
+  @property
+  def err(self):
+    """stderr of this command (str)."""
+    return '\n'.join(self._err)
+
+
+class Batch(object):
+  """Run several commands over one ssh session.
+
+  The commands go out as a single remote script. Each command's stdout is
+  framed by marker lines and handed, line by line, to that section's feed();
+  its end(section) runs as soon as the section is over, before later
+  sections have arrived. Exit status, stderr and timings are kept per
+  section; firstLine is the time.monotonic() the first line of output
+  arrived, None until then.
+  """
+
+  MARK = '=========='
+
+  def __init__(self, conn):
+    self._conn = conn
+    self._sections = {}
+    self._current = None
+    self._inErr = False
+    self.done = False
+    self.firstLine = None
+
+  def Add(self, name, cmd, feed, end=None):
+    """Queue cmd (a list of words); returns its BatchSection."""
+    assert name not in self._sections and ' ' not in name, name
+    section = BatchSection(name, cmd, feed, end)
+    self._sections[name] = section
+    return section
+
+  def __getitem__(self, name):
+    return self._sections[name]
+
+  def __iter__(self):
+    return iter(self._sections.values())
+
+  @property
+  def running(self):
+    """Name of the section whose output is arriving; None between sections."""
+    return self._current.name if self._current else None
+
+  def _marker(self, *words):
+    return '%s%s%s' % (self.MARK, ' '.join(words), self.MARK)
+
+  def Command(self, every=None):
+    """Returns the remote script as a single-word command.
+
+    Given every, the script runs the whole batch again every that many
+    seconds until killed, see StatusStream.
+    """
+    setup = ['e=$(mktemp)', "trap 'rm -f \"$e\"' EXIT"]
+    script = []
+    for name, section in self._sections.items():
+      script.extend([
+          "echo '%s'" % self._marker('starto', name),
+          '{ %s; } 2>"$e"' % ' '.join(section.cmd),
+          'rc=$?',
+          # stderr before the exit status, so end() has both; the extra echo
+          # ends a partial line.
+          "if [ -s \"$e\" ]; then echo '%s'; cat \"$e\"; echo; fi" % self._marker('stderr', name),
+          'echo "%s"' % self._marker('endo', name, '$rc'),
+          ])
+    script.append("echo '%s'" % self._marker('donezo'))
+    if every is None:
+      return ['; '.join(setup + script)]
+    return ['; '.join(setup + ['while :; do %s; sleep %g; done' % ('; '.join(script), every)])]
+
+  def Feed(self, line):
+    """Route one line of output. Returns True once every section is over."""
+    if self.firstLine is None:
+      self.firstLine = time.monotonic()
+    if self._current and not self._inErr and line.endswith(self.MARK) and not line.startswith(self.MARK):
+      # output without a final newline runs into the next marker
+      name = self._current.name
+      i = max(line.rfind(self._marker('stderr', name)), line.rfind('%sendo %s ' % (self.MARK, name)))
+      if i > 0:
+        self.Feed(line[:i])
+        return self.Feed(line[i:])
+    if line.startswith(self.MARK) and line.endswith(self.MARK) and len(line) > 2 * len(self.MARK):
+      words = line[len(self.MARK):-len(self.MARK)].split(' ')
+      kind = words[0]
+      section = self._sections.get(words[1]) if len(words) > 1 else None
+      if kind == 'starto' and section:
+        self._finishErr()
+        self._current = section
+        self._inErr = False
+        section.started = time.monotonic()
+        return False
+      if kind == 'endo' and section and len(words) == 3:
+        self._finishErr()
+        section.returncode = int(words[2])
+        section.ended = time.monotonic()
+        self._current = None
+        if section.end:
+          section.end(section)
+        return False
+      if kind == 'stderr' and section:
+        self._finishErr()
+        self._current = section
+        self._inErr = True
+        return False
+      if kind == 'donezo':
+        self._finishErr()
+        self.done = True
+        return True
+    if self._current is None:
+      return False  # login banner and the like
+    if self._inErr:
+      self._current._err.append(line)
+    else:
+      start = time.perf_counter()
+      self._current.feed(line)
+      self._current.parseSeconds += time.perf_counter() - start
+    return False
+
+  def _finishErr(self):
+    if self._current and self._inErr and self._current._err and not self._current._err[-1]:
+      self._current._err.pop()  # the blank line added by our echo
+    self._current = None
+    self._inErr = False
+
+  def Run(self, callback=None):
+    with self._conn.Stream(self.Command(), callback=callback) as lines:
+      for line in lines:
+        if self.Feed(line):
+          break  # don't wait around after the last section
+
+
+class StatusStream(object):
+  """wlbGetStatus every few seconds over one long-lived session.
+
+  The router runs the command in a loop and every run comes back framed as
+  a one-section Batch, so the handshake is paid once rather than per poll.
+  Feed() the session's stdout lines; done(lines, section) gets the lines
+  of each run's output as soon as they have all arrived, e.g. for a
+  LoadBalanceTracker.
+  """
+
+  def __init__(self, conn, every, done):
+    self._conn = conn
+    self._every = every
+    self._done = done
+    self.frames = 0  # runs received so far
+    self._next()
+
+  def _next(self):
+    lines = []
+    self._batch = Batch(self._conn)
+    self._batch.Add('status', ShowLoadBalanceStatus.COMMAND, lines.append,
+                    lambda section: self._done(lines, section))
+
+  def Command(self):
+    """Returns the remote loop as a single-word command."""
+    return self._batch.Command(every=self._every)
+
+  def Feed(self, line):
+    """Route one line of output. Returns the Batch of a run it completed, else None."""
+    batch = self._batch
+    if not batch.Feed(line):
+      return None
+    self.frames += 1
+    self._next()
+    return batch
+
+
+# The classes below use __slots__: a router's status is parsed every poll
+# and the daemon keeps the recent ones around.
+
 
 class LoadBalance(object):
 
+  __slots__ = ('_groups',)
+
   def __init__(self):
     self._groups = []
 
+  @property
+  def groups(self):
+    """LoadBalanceGroups in output order."""
+    return self._groups
+
+  def links(self):
+    """Returns {(group, interface): (reachable, status)}."""
+    return {(g._name, i._name): (i._reachable, i._status) for g in self._groups for i in g._interfaces}
+
   def __str__(self):
     out = []
     for g in self._groups:
@@ -45,6 +454,8 @@ def truefalse(b):
 
 class LoadBalanceGroup(object):
 
+  __slots__ = ('_name', '_balanceLocal', '_lockLocalDNS', '_conntrackFlush', '_stickyBits', '_interfaces')
+
   def __init__(self, name):
     self._name = name
     self._balanceLocal = None
@@ -53,6 +464,16 @@ class LoadBalanceGroup(object):
     self._stickyBits = None
     self._interfaces = []
 
+  @property
+  def name(self):
+    """Group name."""
+    return self._name
+
+  @property
+  def interfaces(self):
+    """LoadBalanceGroupInterfaces in output order."""
+    return self._interfaces
+
   def __str__(self):
     out = [
         'Group %s' % self._name,
@@ -69,6 +490,9 @@ class LoadBalanceGroup(object):
 
 class LoadBalanceGroupInterface(object):
 
+  __slots__ = ('_name', '_reachable', '_status', '_gateway', '_routeTable', '_weight', '_foPriority',
+               '_flows')
+
   def __init__(self, name):
     self._name = name
     self._reachable = None
@@ -79,6 +503,31 @@ class LoadBalanceGroupInterface(object):
     self._foPriority = None
     self._flows = []
 
+  @property
+  def name(self):
+    """Interface name, e.g. eth0."""
+    return self._name
+
+  @property
+  def reachable(self):
+    """'true', 'false', or None if not reported."""
+    return self._reachable
+
+  @property
+  def status(self):
+    """'active', 'inactive', 'failover', or None if not reported."""
+    return self._status
+
+  @property
+  def weight(self):
+    """Share of new flows in percent (int), or None if not reported."""
+    return self._weight
+
+  @property
+  def flows(self):
+    """LoadBalanceGroupInterfaceFlows, or None if not reported."""
+    return self._flows or None
+
   def __str__(self):
     out = [
         '  interface   : %s' % self._name,
@@ -86,7 +535,7 @@ class LoadBalanceGroupInterface(object):
         '  status      : %s' % self._status,
         '  gateway     : %s' % self._gateway,
         '  route table : %s' % self._routeTable,
-        '  weight      : %s' % self._weight,
+        '  weight      : %s' % (self._weight if self._weight is None else '%d%%' % self._weight),
         '  fo_priority : %s' % self._foPriority,
       ]
     out.append(str(self._flows))
@@ -94,6 +543,12 @@ class LoadBalanceGroupInterface(object):
 
 
 class LoadBalanceGroupInterfaceFlows(object):
+  """Flow counters (ints) of one interface; None if not reported."""
+
+  __slots__ = ('_wanOut', '_wanIn', '_localIcmp', '_localDns', '_localData')
+
+  # names of the counters, in the order of counts()
+  NAMES = ('wan_out', 'wan_in', 'local_icmp', 'local_dns', 'local_data')
 
   def __init__(self):
     self._wanOut = None
@@ -102,6 +557,10 @@ class LoadBalanceGroupInterfaceFlows(object):
     self._localDns = None
     self._localData = None
 
+  def counts(self):
+    """Returns the counters as a tuple, in the order of NAMES."""
+    return (self._wanOut, self._wanIn, self._localIcmp, self._localDns, self._localData)
+
   def __str__(self):
     out = [
         '  flows',
@@ -115,140 +574,250 @@ class LoadBalanceGroupInterfaceFlows(object):
     return '\n'.join(out)
 
 
+# wlbGetStatus field label (everything before ": ", indent included) ->
+# (scope, attribute, accepted value pattern or None for anything, and
+# whether the match is an int; strings are interned).
+_GROUP, _INTERFACE, _FLOWS = range(3)
+_TRUEFALSE = re.compile(r'true|false')
+_COUNT = re.compile(r'[0-9]+')
+_STATUS_FIELDS = {
+    '    Balance Local  ': (_GROUP, '_balanceLocal', _TRUEFALSE, False),
+    '    Lock Local DNS ': (_GROUP, '_lockLocalDNS', _TRUEFALSE, False),
+    '    Conntrack Flush': (_GROUP, '_conntrackFlush', _TRUEFALSE, False),
+    '    Sticky Bits    ': (_GROUP, '_stickyBits', re.compile(r'0x[0-9]*'), False),
+    '  reachable   ': (_INTERFACE, '_reachable', _TRUEFALSE, False),
+    '  status      ': (_INTERFACE, '_status', None, False),
+    '  gateway     ': (_INTERFACE, '_gateway', None, False),
+    '  route table ': (_INTERFACE, '_routeTable', None, False),
+    '  weight      ': (_INTERFACE, '_weight', _COUNT, True),  # e.g. 50%
+    '  fo_priority ': (_INTERFACE, '_foPriority', None, False),
+    '      WAN Out   ': (_FLOWS, '_wanOut', _COUNT, True),
+    '      WAN In    ': (_FLOWS, '_wanIn', _COUNT, True),
+    '      Local ICMP': (_FLOWS, '_localIcmp', _COUNT, True),
+    '      Local DNS ': (_FLOWS, '_localDns', _COUNT, True),
+    '      Local Data': (_FLOWS, '_localData', _COUNT, True),
+}
+_INTERFACE_LABEL = '  interface   '
+
+
 class ShowLoadBalanceStatus(object):
 
+  COMMAND = ['/usr/sbin/ubnt-hal', 'wlbGetStatus']
+
   def __init__(self, conn):
     self._conn = conn
     self._d = LoadBalance()
+    self._current = [None, None, None]  # group, interface, flows
+
+  @property
+  def status(self):
+    """The LoadBalance parsed so far; complete once the command has ended."""
+    return self._d
 
   def Run(self, callback=None):
-    out, err = self._conn.Run(
-        ['/usr/sbin/ubnt-hal', 'wlbGetStatus'], callback=callback)
-    current_group = None
-    current_interface = None
-    current_flows = None
+    with self._conn.Stream(self.COMMAND, callback=callback) as lines:
+      for line in lines:
+        self.Feed(line)
+
+  def Parse(self, out):
+    """Parse wlbGetStatus output (bytes)."""
     for line in out.decode('utf-8').split('\n'):
-      m = re.match(r'^Group (.*)', line)
-      if m:
-        n = LoadBalanceGroup(m.group(1))
-        self._d._groups.append(n)
-        current_group = n
-        current_interface = None
-        current_flows = None
-        continue
-      if current_group:
-        m = re.match(r'^    Balance Local  : (true|false)', line)
-        if m:
-          current_group._balanceLocal = m.group(1)
-          continue
-        m = re.match(r'^    Lock Local DNS : (true|false)', line)
-        if m:
-          current_group._lockLocalDNS = m.group(1)
-          continue
-        m = re.match(r'^    Conntrack Flush: (true|false)', line)
-        if m:
-          current_group._conntrackFlush = m.group(1)
-          continue
-        m = re.match(r'^    Sticky Bits    : (0x[0-9]*)', line)
-        if m:
-          current_group._stickyBits = m.group(1)
-          continue
-        m = re.match(r'^  interface   : (.*)', line)
-        if m:
-          n = LoadBalanceGroupInterface(m.group(1))
-          current_group._interfaces.append(n)
-          current_interface = n
-        # else logging.error()
-      if current_interface:
-        m = re.match(r'^  reachable   : (true|false)', line)
-        if m:
-          current_interface._reachable = m.group(1)
-          continue
-        m = re.match(r'^  status      : (.*)', line)
-        if m:
-          current_interface._status = m.group(1)
-          continue
-        m = re.match(r'^  gateway     : (.*)', line)
-        if m:
-          current_interface._gateway = m.group(1)
-          continue
-        m = re.match(r'^  route table : (.*)', line)
-        if m:
-          current_interface._routeTable = m.group(1)
-          continue
-        m = re.match(r'^  weight      : (.*)', line)
-        if m:
-          current_interface._weight = m.group(1)
-          continue
-        m = re.match(r'^  fo_priority : (.*)', line)
-        if m:
-          current_interface._foPriority = m.group(1)
-          continue
-        m = re.match(r'^  flows$', line)
-        if m:
-          current_interface._flows = LoadBalanceGroupInterfaceFlows()
-          current_flows = current_interface._flows
-        # else logging.error()
-      if current_flows:
-        m = re.match(r'^      WAN Out   : (.*)', line)
-        if m:
-          current_flows._wanOut = m.group(1)
-          continue
-        m = re.match(r'^      WAN In    : (.*)', line)
-        if m:
-          current_flows._wanIn = m.group(1)
-          continue
-        m = re.match(r'^      Local ICMP: (.*)', line)
-        if m:
-          current_flows._localIcmp = m.group(1)
-          continue
-        m = re.match(r'^      Local DNS : (.*)', line)
-        if m:
-          current_flows._localDns = m.group(1)
-          continue
-        m = re.match(r'^      Local Data: (.*)', line)
-        if m:
-          current_flows._localData = m.group(1)
+      self.Feed(line)
+
+  def Feed(self, line):
+    """Parse one line of wlbGetStatus output.
+
+    Every line is classified once, by a dict lookup on its field label.
+    """
+    current = self._current
+    label, sep, value = line.partition(': ')
+    field = _STATUS_FIELDS.get(label) if sep else None
+    if field:
+      scope, attr, pattern, number = field
+      target = current[scope]
+      if target:
+        if pattern:
+          m = pattern.match(value)
+          if not m:
+            return  # else logging.error()
+          value = m.group(0)
+        if number:
+          value = int(value)
+        else:
+          value = sys.intern(value)  # the same few strings in every status
+        setattr(target, attr, value)
+      return
+    if label == _INTERFACE_LABEL and sep:
+      if current[_GROUP]:
+        n = LoadBalanceGroupInterface(sys.intern(value))
+        current[_GROUP]._interfaces.append(n)
+        current[_INTERFACE] = n
+      return
+    if line.startswith('Group '):
+      n = LoadBalanceGroup(sys.intern(line[6:]))
+      self._d._groups.append(n)
+      current[:] = [n, None, None]
+      return
+    if line == '  flows' and current[_INTERFACE]:
+      current[_INTERFACE]._flows = LoadBalanceGroupInterfaceFlows()
+      current[_FLOWS] = current[_INTERFACE]._flows
+    # else logging.error()
+
+
+# Kinds of Transition.
+FAILOVER_STARTED = 'failover_started'  # status became inactive
+FAILOVER_ENDED = 'failover_ended'  # status no longer inactive
+REACHABLE_FLIPPED = 'reachable_flipped'
+
+Transition = collections.namedtuple('Transition', 'kind group interface old new')
+
+
+class LoadBalanceTracker(object):
+  """One router's load-balance status, kept up to date from raw output.
+
+  Update() hashes each wlbGetStatus output and only parses it when it
+  differs from the last one. A changed status is compared with the one
+  before, interface by interface, for Transitions. Interfaces that appear
+  or disappear have none.
+  """
+
+  COMMAND = ShowLoadBalanceStatus.COMMAND
+
+  def __init__(self):
+    self._digest = None
+    self.status = None  # newest LoadBalance
+    self.links = {}  # its links()
+
+  def Update(self, lines):
+    """Takes the lines of one wlbGetStatus output.
+
+    Returns None if it is the same as the last one, else the Transitions
+    since then (none for the first).
+    """
+    digest = hashlib.sha1('\n'.join(lines).encode('utf-8')).digest()
+    if digest == self._digest:
+      return None
+    lb = ShowLoadBalanceStatus(None)
+    for line in lines:
+      lb.Feed(line)
+    links = lb.status.links()
+    transitions = []
+    if self.status is not None:
+      for key, (reachable, status) in links.items():
+        if key not in self.links:
           continue
-        # else logging.error()
+        old_reachable, old_status = self.links[key]
+        if status != old_status and 'inactive' in (status, old_status):
+          kind = FAILOVER_STARTED if status == 'inactive' else FAILOVER_ENDED
+          transitions.append(Transition(kind, key[0], key[1], old_status, status))
+        if reachable != old_reachable:
+          transitions.append(Transition(REACHABLE_FLIPPED, key[0], key[1], old_reachable, reachable))
+    self._digest = digest
+    self.status = lb.status
+    self.links = links
+    return transitions
+
 
 class ShowConfig(object):
+  """Fetch /config/config.boot.
 
-  def __init__(self, conn):
+  Given the md5 of the copy we already have (unless_md5), the router checks
+  it first and skips the transfer when nothing changed; .changed tells which.
+  Configs larger than compress_over bytes come across gzipped. Either way the
+  router reports the file's md5 and size in .md5 and .size.
+  """
+
+  PATH = '/config/config.boot'
+  COMMAND = ['cat', PATH]
+
+  def __init__(self, conn, sink=None, unless_md5=None, compress_over=None):
+    """With a sink (a text file object), the config is written there as it
+    arrives instead of being kept in memory.
+    """
     self._conn = conn
-    self._d = LoadBalance()
     self._config = []
+    self._sink = sink
+    self._pendingNewline = False
+    self.done = False  # True once the whole config has arrived
+    self.changed = True
+    self.md5 = None
+    self.size = None
+    self._mode = 'plain'
+    if unless_md5 is not None or compress_over is not None:
+      # header lines first: "md5 <hex> size <bytes>", then how the content
+      # follows: unchanged (nothing), gzip (gzip|base64) or plain.
+      self._mode = 'header'
+      self.COMMAND = [
+          'd=$(md5sum %s);' % self.PATH, 'd=${d%% *};',
+          's=$(stat -c %%s %s);' % self.PATH,
+          'echo "md5 $d size $s";',
+          'if [ "$d" = "%s" ]; then echo unchanged;' % (unless_md5 or ''),
+          'elif [ "$s" -gt %d ]; then echo gzip; gzip -c %s | base64;' % (
+              compress_over if compress_over is not None else 2**62, self.PATH),
+          'else echo plain; cat %s; fi' % self.PATH]
 
   def Run(self, callback=None):
-    START = '==========starto=========='
-    END = '==========endo=========='
-    out, err = self._conn.Run(
-        ['echo', START, ';',
-         'cat', '/config/config.boot', ';',
-         'echo', END], callback=callback)
-
-    mode = 0
-    for line in out.decode('utf-8').split('\n'):
-      if mode == 0 and line == START:
-        mode = 1
-        continue
-      if mode == 1:
-        if line == END:
-          break
-        self._config.append(line)
+    batch = Batch(self._conn)
+    batch.Add('config', self.COMMAND, self.Feed, self.End)
+    batch.Run(callback=callback)
+
+  def Feed(self, line):
+    """Take one line of output."""
+    if self._mode == 'plain':
+      self._write(line + '\n')
+    elif self._mode == 'gzip':
+      text = self._gunzip.decompress(binascii.a2b_base64(line))
+      self._write(self._decoder.decode(text))
+    elif self._mode == 'header':
+      words = line.split(' ')
+      if len(words) == 4 and words[0] == 'md5' and words[2] == 'size':
+        self.md5 = words[1]
+        self.size = int(words[3]) if words[3].isdigit() else None
+        self._mode = 'how'
+    elif self._mode == 'how':
+      self._mode = line
+      if line == 'unchanged':
+        self.changed = False
+      elif line == 'gzip':
+        self._gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+  def _write(self, text):
+    """Append text; the file's final newline is dropped, as it always was."""
+    if not text:
+      return
+    if self._pendingNewline:
+      text = '\n' + text
+    self._pendingNewline = text.endswith('\n')
+    if self._pendingNewline:
+      text = text[:-1]
+    if self._sink is None:
+      self._config.append(text)
+    else:
+      self._sink.write(text)
+
+  def End(self, section):
+    """Batch callback: the config is complete if the command succeeded."""
+    self.done = section.returncode == 0 and self._mode in ('plain', 'gzip', 'unchanged')
+    if self.done and self._mode == 'gzip':
+      self._write(self._decoder.decode(self._gunzip.flush(), final=True))
+      self.done = self._gunzip.eof
 
   def __str__(self):
-    return('\n'.join(self._config))
+    return(''.join(self._config))
 
 
 if __name__ == '__main__':
   c = SshConnection('EdgeRouterScraper')
+  # both commands, one ssh session
   lb = ShowLoadBalanceStatus(c)
-  lb.Run()
+  conf = ShowConfig(c)
+  batch = Batch(c)
+  batch.Add('status', lb.COMMAND, lb.Feed)
+  batch.Add('config', conf.COMMAND, conf.Feed, conf.End)
+  batch.Run()
   print(str(lb._d))
 
-  conf = ShowConfig(c)
-  conf.Run()
   if len(str(conf)) != 0:
     with open('/tmp/conf', 'w') as fh:
       fh.write(str(conf))
@@ -0,0 +1,6 @@
+"""Round-trip checks of the wire framing and the archive format.
+
+Nothing here needs a router; commands run through fakerouter.FakeRouter.
+
+  python3 -m unittest discover -s tests -t .
+"""
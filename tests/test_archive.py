@@ -0,0 +1,104 @@
+"""archive.Store pack and index format."""
+
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import archive
+
+
+def _config(i):
+  return '\n'.join('line %d' % (n if n != i % 50 else -i) for n in range(50)) + '\n'
+
+
+class StoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def testRoundTrip(self):
+    store = archive.Store(self.dir)
+    n = 2 * archive.KEYFRAME + 5
+    for i in range(1, n + 1):
+      self.assertEqual(i, store.commit(_config(i), timestamp=1000 + i))
+    reopened = archive.Store(self.dir)
+    self.assertEqual(n, reopened.version)
+    self.assertEqual(n * archive.RECORD.size, os.path.getsize(os.path.join(self.dir, 'index')))
+    for i in range(1, n + 1):
+      self.assertEqual(_config(i), reopened.get(i))
+      self.assertEqual(1000 + i, reopened.timestamp(i))
+    self.assertLessEqual(len(reopened._chain(n)), archive.KEYFRAME)
+    with open(os.path.join(self.dir, 'latest')) as fh:
+      self.assertEqual(_config(n), fh.read())
+
+  def testUnchangedAndRepeated(self):
+    store = archive.Store(self.dir)
+    self.assertEqual(1, store.commit('a\n'))
+    self.assertEqual(1, store.commit('a\n'))
+    self.assertEqual(2, store.commit('b\n'))
+    self.assertEqual(3, store.commit('a\n'))
+    self.assertEqual(archive.SAME, store._record(3)[2])
+    self.assertEqual('a\n', archive.Store(self.dir).get(3))
+
+  def testTornIndex(self):
+    store = archive.Store(self.dir)
+    store.commit('a\n', timestamp=1)
+    store.commit('b\n', timestamp=2)
+    with open(os.path.join(self.dir, 'index'), 'ab') as fh:
+      fh.write(b'torn')
+    index = os.path.join(self.dir, 'index')
+    store = archive.Store(self.dir)
+    self.assertEqual(2, store.version)
+    self.assertEqual(2 * archive.RECORD.size + 4, os.path.getsize(index))  # readers leave it be
+    store.commit('c\n', timestamp=3)
+    self.assertEqual(3 * archive.RECORD.size, os.path.getsize(index))
+    reopened = archive.Store(self.dir)
+    self.assertEqual(3, reopened.version)
+    self.assertEqual(['a\n', 'b\n', 'c\n'], [reopened.get(v) for v in (1, 2, 3)])
+
+  def testPacks(self):
+    with mock.patch.object(archive, 'PACK_LIMIT', 100):
+      store = archive.Store(self.dir)
+      for i in range(1, 21):
+        store.commit(_config(i) * 5)
+    reopened = archive.Store(self.dir)
+    self.assertGreater(len([fn for fn in os.listdir(self.dir) if fn.startswith('pack-')]), 1)
+    for i in range(1, 21):
+      self.assertEqual(_config(i) * 5, reopened.get(i))
+
+  def testClockStepsBack(self):
+    store = archive.Store(self.dir)
+    store.commit('a\n')
+    newest = store.timestamp(1)
+    with mock.patch.object(time, 'time', return_value=newest - 3600):
+      self.assertEqual(2, store.commit('b\n'))
+    self.assertEqual(newest, store.timestamp(2))
+    self.assertEqual(2, store.at(newest))
+
+  def testOutOfOrder(self):
+    store = archive.Store(self.dir)
+    store.commit('a\n', timestamp=100)
+    with self.assertRaises(archive.OutOfOrderError):
+      store.commit('b\n', timestamp=99)
+    self.assertEqual(1, archive.Store(self.dir).version)
+
+  def testAt(self):
+    store = archive.Store(self.dir)
+    store.commit('a\n', timestamp=100)
+    store.commit('b\n', timestamp=200)
+    self.assertEqual(1, store.at(150))
+    self.assertEqual(2, store.at(200))
+    with self.assertRaises(archive.UnknownVersionError):
+      store.at(50)
+    with self.assertRaises(archive.UnknownVersionError):
+      store.get(3)
+
+
+if __name__ == '__main__':
+  unittest.main()
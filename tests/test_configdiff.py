@@ -0,0 +1,210 @@
+"""configdiff parsing, diffing and its parse cache."""
+
+import io
+import mmap
+import os
+import tempfile
+import unittest
+
+import configdiff
+
+
+CONFIG = b'''firewall {
+    all-ping enable
+}
+system {
+    host-name gw
+}
+'''
+
+class ParseTest(unittest.TestCase):
+
+  def _error(self, source):
+    with self.assertRaises(configdiff.ParseError) as raised:
+      configdiff.parse(source)
+    return raised.exception
+
+  def testErrors(self):
+    for source, lineno, what in (
+        (b'}\nsystem {\n}\n', 1, "'}' before the first section"),
+        (b'system {\n}\n    }\n', 3, "'}' without a section to end"),
+        (b'system {\n    a b\n\n    c d\n}\n', 3, "blank line inside section 'system'"),
+        (b'system {\n    a b\n', 3, "input ends inside section 'system'"),  # at the empty last line
+        (b'system {\n    a b', 2, "input ends inside section 'system'"),
+        (b'a {\n}\nsystem {\n    b {\n    }\n    b {\n', 6, "duplicate section 'b'"),
+        (b'system {\n}\n    x y\n', 3, "entry outside of any section: 'x y'")):
+      e = self._error(source)
+      self.assertEqual(lineno, e.lineno, source)
+      self.assertEqual('line %d: %s' % (lineno, what), str(e))
+
+  def testErrorInFile(self):
+    e = self._error(io.BytesIO(b'system {\n    a b\n}\n}\n'))
+    self.assertEqual(4, e.lineno)
+
+  def testSources(self):
+    want = configdiff.parse(CONFIG)
+    self.assertEqual(['firewall', 'system'], sorted(want.keys()))
+    with tempfile.TemporaryFile() as fh:
+      fh.write(CONFIG)
+      fh.flush()
+      fh.seek(0)
+      with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        sources = [CONFIG.decode('utf-8'), bytearray(CONFIG), io.BytesIO(CONFIG),
+                   io.StringIO(CONFIG.decode('utf-8')), mapped, fh]
+        for source in sources:
+          got = configdiff.parse(source)
+          self.assertEqual((want.digest, str(want)), (got.digest, str(got)), type(source))
+
+  def testNoFinalNewline(self):
+    self.assertEqual(configdiff.parse(CONFIG).digest, configdiff.parse(CONFIG[:-1]).digest)
+    self.assertEqual(configdiff.parse(CONFIG).digest, configdiff.parse(io.BytesIO(CONFIG[:-1])).digest)
+
+
+# eth0 and eth2 change; eth1 between them, lo and system after do not
+INTERFACES = b'''interfaces {
+    ethernet eth0 {
+        address 10.0.0.1/24
+        duplex auto
+    }
+    ethernet eth1 {
+        address 10.0.1.1/24
+        duplex auto
+        speed auto
+    }
+    ethernet eth2 {
+        address 10.0.2.1/24
+        duplex auto
+    }
+    loopback lo {
+    }
+}
+system {
+    host-name gw
+}
+'''
+INTERFACES_CHANGED = INTERFACES.replace(b'10.0.0.1/24', b'10.0.0.2/24').replace(b'10.0.2.1/24', b'10.0.2.2/24')
+
+
+def _indent(line):
+  return len(line) - len(line.lstrip(' '))
+
+
+def _collapses(out, full, i=0, j=0):
+  """Whether out[i:] is full[j:] with runs of unchanged lines each swapped
+  for one "...", indented like the first line of its run.
+  """
+  if i == len(out):
+    return j == len(full)
+  line = out[i]
+  if not line.endswith('...'):
+    return j < len(full) and full[j] == line and _collapses(out, full, i + 1, j + 1)
+  if j == len(full) or _indent(full[j]) != _indent(line):
+    return False
+  for k in range(j + 1, len(full) + 1):
+    if full[k - 1][0] in '-+':
+      return False
+    if _collapses(out, full, i + 1, k):
+      return True
+  return False
+
+
+class ContextTest(unittest.TestCase):
+  """udiff(context=n), i.e. -U n, against the --full output."""
+
+  def _udiff(self, lhs, rhs, context):
+    return list(configdiff.parse(lhs).udiff(configdiff.parse(rhs), context))
+
+  def testU0(self):
+    self.assertEqual([
+        ' interfaces {',
+        '     ethernet eth0 {',
+        '-        address 10.0.0.1/24',
+        '+        address 10.0.0.2/24',
+        '         ...',
+        '     }',
+        '     ...',
+        '     ethernet eth2 {',
+        '-        address 10.0.2.1/24',
+        '+        address 10.0.2.2/24',
+        '         ...',
+        '     }',
+        '     ...',
+        ' }',
+        ' ...',
+    ], self._udiff(INTERFACES, INTERFACES_CHANGED, 0))
+
+  def testU3(self):
+    self.assertEqual([
+        ' interfaces {',
+        '     ethernet eth0 {',
+        '-        address 10.0.0.1/24',
+        '+        address 10.0.0.2/24',
+        '         duplex auto',
+        '     }',
+        '     ethernet eth1 {',
+        '         address 10.0.1.1/24',
+        '         ...',
+        '     ethernet eth2 {',
+        '-        address 10.0.2.1/24',
+        '+        address 10.0.2.2/24',
+        '         duplex auto',
+        '     }',
+        '     loopback lo {',
+        '     }',
+        ' }',
+        ' ...',
+    ], self._udiff(INTERFACES, INTERFACES_CHANGED, 3))
+
+  def testLeadingSubtreeCollapsed(self):
+    lhs = b'a {\n    a1 x\n    a2 x\n}\nb {\n    b1 x\n    b2 x\n    b3 x\n}\n'
+    rhs = lhs.replace(b'b3 x', b'b3 y')
+    self.assertEqual([' ...', ' b {', '     ...', '     b2 x', '-    b3 x', '+    b3 y', ' }'],
+                     self._udiff(lhs, rhs, 1))
+
+  def testAgainstFull(self):
+    lhs = INTERFACES
+    for rhs in (INTERFACES_CHANGED,
+                INTERFACES.replace(b'speed auto', b'speed 1000'),
+                INTERFACES.replace(b'    loopback lo {\n    }\n', b'').replace(b'host-name gw', b'host-name r1')):
+      full = self._udiff(lhs, rhs, None)
+      changes = [line for line in full if line[0] in '-+']
+      for context in range(8):
+        out = self._udiff(lhs, rhs, context)
+        self.assertEqual(changes, [line for line in out if line[0] in '-+'])
+        self.assertFalse([a for a, b in zip(out, out[1:]) if a.endswith('...') and b.endswith('...')])
+        self.assertTrue(_collapses(out, full), (context, out))
+
+
+class ParseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.dir = self._tmp.name
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def _touch(self, name):
+    with open(os.path.join(self.dir, name), 'w') as fh:
+      fh.write('x')
+
+  def testHit(self):
+    cache = configdiff.ParseCache(self.dir)
+    first = cache.parse(CONFIG)
+    again = configdiff.ParseCache(self.dir).parse(CONFIG)
+    self.assertEqual(first.digest, again.digest)
+    self.assertEqual(1, len(os.listdir(self.dir)))
+
+  def testOnlyEvictsOwnFiles(self):
+    sha1 = 'a' * 40
+    foreign = ['notes.txt', 'config.boot', sha1, sha1 + '.v1.bak', 'A' * 40 + '.v1', '.hidden']
+    for name in foreign + [sha1 + '.v1', sha1 + '.v%d' % configdiff.PARSER_VERSION]:
+      self._touch(name)
+    cache = configdiff.ParseCache(self.dir, max_bytes=0)
+    cache.parse(CONFIG)
+    left = set(os.listdir(self.dir))
+    self.assertEqual(set(foreign), left)
+
+
+if __name__ == '__main__':
+  unittest.main()
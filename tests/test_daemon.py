@@ -0,0 +1,63 @@
+"""daemon.Engine poll cycles, and what _observeBatch records of them, against
+fakerouter.FakeRouter.
+"""
+
+import asyncio
+import logging
+import os
+import tempfile
+import unittest
+
+import prometheus_client
+
+import daemon
+import fakerouter
+from tests import test_poll
+
+
+def _sample(name, **labels):
+  return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+
+class CycleTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.recording = fakerouter.Recording.write(
+        os.path.join(self._tmp.name, 'recording'), [test_poll.STATUS], [test_poll.CONFIG])
+    logging.disable(logging.ERROR)
+
+  def tearDown(self):
+    logging.disable(logging.NOTSET)
+    self._tmp.cleanup()
+
+  def _cycle(self, router, **faults):
+    engine = daemon.Engine({router: fakerouter.FakeRouter(self.recording, **faults)},
+                           os.path.join(self._tmp.name, 'logs'), timeout=5, jitter=0)
+    asyncio.run(engine.cycle(router, config=True))
+    return engine
+
+  def testStatusAndConfig(self):
+    engine = self._cycle('cycle-ok')
+    self.assertEqual(('true', 'active'), engine._trackers['cycle-ok'].links[('G', 'eth0')])
+    self.assertEqual(1, _sample('config_version', router='cycle-ok'))
+    for stage in ('connect', 'status', 'config'):
+      self.assertEqual(1, _sample('poll_seconds_count', stage=stage, router='cycle-ok'))
+    self.assertEqual(0, _sample('poll_nonzero_exits_total', stage='status', router='cycle-ok'))
+
+  def testNonZeroExit(self):
+    engine = self._cycle('cycle-fail', fail=1)
+    self.assertIsNone(engine._trackers['cycle-fail'].status)
+    self.assertEqual(1, _sample('poll_nonzero_exits_total', stage='status', router='cycle-fail'))
+    self.assertEqual(1, _sample('poll_stderr_total', stage='status', router='cycle-fail'))
+    self.assertEqual(1, _sample('config_version', router='cycle-fail'))
+
+  def testTruncated(self):
+    self._cycle('cycle-cut', truncate=1, seed=0)
+    self.assertEqual(1, _sample('poll_nonzero_exits_total', stage='ssh', router='cycle-cut'))
+    self.assertEqual(0, _sample('config_version', router='cycle-cut'))
+    self.assertEqual(0, _sample('poll_seconds_count', stage='config', router='cycle-cut'))
+
+
+if __name__ == '__main__':
+  unittest.main()
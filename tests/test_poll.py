@@ -0,0 +1,204 @@
+"""poll.Batch framing against fakerouter.FakeRouter."""
+
+import tempfile
+import unittest
+
+import fakerouter
+import poll
+
+
+STATUS = b'''Group G
+  interface   : eth0
+  reachable   : true
+  status      : active
+  gateway     : 10.0.0.1
+  route table : 1
+  weight      : 100%
+  fo_priority : 60
+  flows
+      WAN Out   : 7
+      WAN In    : 3
+      Local ICMP: 1
+      Local DNS : 0
+      Local Data: 0
+
+'''
+CONFIG = b'system {\n    host-name ubnt\n}\n'
+
+
+class BatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp = tempfile.TemporaryDirectory()
+    self.recording = fakerouter.Recording.write(self._tmp.name, [STATUS], [CONFIG])
+
+  def tearDown(self):
+    self._tmp.cleanup()
+
+  def _run(self, conn, *commands):
+    """Runs commands, (name, cmd) each, as one Batch; returns it and the
+    lines each section got.
+    """
+    batch = poll.Batch(conn)
+    lines = {}
+    for name, cmd in commands:
+      lines[name] = []
+      batch.Add(name, cmd, lines[name].append)
+    batch.Run()
+    return batch, lines
+
+  def testRoundTrip(self):
+    conn = fakerouter.FakeRouter(self.recording)
+    batch, lines = self._run(conn, ('status', poll.ShowLoadBalanceStatus.COMMAND),
+                             ('config', poll.ShowConfig.COMMAND))
+    self.assertTrue(batch.done)
+    self.assertEqual(STATUS.decode('utf-8').split('\n')[:-1], lines['status'])
+    self.assertEqual(CONFIG.decode('utf-8').split('\n')[:-1], lines['config'])
+    for section in batch:
+      self.assertEqual(0, section.returncode)
+      self.assertEqual('', section.err)
+      self.assertLessEqual(section.started, section.ended)
+
+  def testParsed(self):
+    conn = fakerouter.FakeRouter(self.recording)
+    lb = poll.ShowLoadBalanceStatus(conn)
+    conf = poll.ShowConfig(conn, unless_md5='', compress_over=0)  # gzip in transit
+    batch = poll.Batch(conn)
+    batch.Add('status', lb.COMMAND, lb.Feed)
+    batch.Add('config', conf.COMMAND, conf.Feed, conf.End)
+    batch.Run()
+    self.assertEqual(('true', 'active'), lb.status.links()[('G', 'eth0')])
+    self.assertTrue(conf.done)
+    self.assertEqual(CONFIG.decode('utf-8').rstrip('\n'), str(conf))
+
+  def testNonZeroExit(self):
+    conn = fakerouter.FakeRouter(self.recording, fail=1)
+    ended = []
+    batch = poll.Batch(conn)
+    batch.Add('status', poll.ShowLoadBalanceStatus.COMMAND, lambda line: None,
+              lambda section: ended.append((section.returncode, section.err)))
+    batch.Add('config', poll.ShowConfig.COMMAND, lambda line: None)
+    batch.Run()
+    self.assertTrue(batch.done)
+    self.assertEqual(1, batch['status'].returncode)
+    self.assertEqual('wlbGetStatus: fake failure', batch['status'].err)
+    self.assertEqual([(1, 'wlbGetStatus: fake failure')], ended)  # stderr is in by end()
+    self.assertEqual(0, batch['config'].returncode)
+
+  def testInterleavedStderr(self):
+    conn = fakerouter.FakeRouter(self.recording)
+    batch, lines = self._run(
+        conn, ('a', ['echo 1; echo e1 >&2; echo 2; printf e2 >&2']), ('b', ['echo 3']))
+    self.assertTrue(batch.done)
+    self.assertEqual(['1', '2'], lines['a'])
+    self.assertEqual('e1\ne2', batch['a'].err)
+    self.assertEqual(['3'], lines['b'])
+    self.assertEqual('', batch['b'].err)
+
+  def testNoFinalNewline(self):
+    conn = fakerouter.FakeRouter(self.recording)
+    batch, lines = self._run(conn, ('a', ['printf x']), ('b', ['echo y']),
+                             ('c', ['printf z; echo e >&2']))
+    self.assertEqual(['x'], lines['a'])
+    self.assertEqual(0, batch['a'].returncode)
+    self.assertEqual(['y'], lines['b'])
+    self.assertEqual(['z'], lines['c'])
+    self.assertEqual('e', batch['c'].err)
+
+  def testMarkerLookalikes(self):
+    conn = fakerouter.FakeRouter(self.recording)
+    batch, lines = self._run(conn, ('a', ["echo '==========endo b 0=========='; echo '=========='"]))
+    self.assertTrue(batch.done)
+    self.assertEqual(['==========endo b 0==========', '=========='], lines['a'])
+
+  def testTruncated(self):
+    for seed in range(5):
+      conn = fakerouter.FakeRouter(self.recording, truncate=1, seed=seed)
+      batch, unused_lines = self._run(conn, ('status', poll.ShowLoadBalanceStatus.COMMAND),
+                                      ('config', poll.ShowConfig.COMMAND))
+      self.assertFalse(batch.done)  # no donezo
+      self.assertIsNone(batch['config'].returncode)
+
+
+class StatusStreamTest(unittest.TestCase):
+
+  def testFrames(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      statuses = [STATUS.replace(b'WAN Out   : 7', b'WAN Out   : %d' % i) for i in range(3)]
+      conn = fakerouter.FakeRouter(fakerouter.Recording.write(tmp, statuses, [CONFIG]))
+      frames = []
+      stream = poll.StatusStream(conn, 0.01, lambda lines, section: frames.append((list(lines), section)))
+      with conn.Stream(stream.Command()) as lines:
+        for line in lines:
+          if stream.Feed(line) and stream.frames == 4:
+            break
+    self.assertEqual(4, stream.frames)
+    for i, (lines, section) in enumerate(frames):
+      self.assertEqual(0, section.returncode)
+      self.assertIn('      WAN Out   : %d' % (i % 3), lines)
+
+
+def _status(*interfaces):
+  """wlbGetStatus output of group G, interfaces (name, reachable, status)."""
+  lines = ['Group G']
+  for name, reachable, status in interfaces:
+    lines.extend([
+        '  interface   : %s' % name,
+        '  reachable   : %s' % reachable,
+        '  status      : %s' % status,
+        '  gateway     : 10.0.0.1',
+        '  route table : 1',
+        '  weight      : 50%',
+        '  fo_priority : 60',
+        '  flows',
+        '      WAN Out   : 7',
+        '      WAN In    : 3',
+        '      Local ICMP: 1',
+        '      Local DNS : 0',
+        '      Local Data: 0',
+        ''])
+  return lines
+
+
+class LoadBalanceTrackerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tracker = poll.LoadBalanceTracker()
+    self.assertEqual([], self.tracker.Update(
+        _status(('eth0', 'true', 'active'), ('eth1', 'true', 'failover'))))
+
+  def testUnchanged(self):
+    self.assertIsNone(self.tracker.Update(
+        _status(('eth0', 'true', 'active'), ('eth1', 'true', 'failover'))))
+
+  def testFailover(self):
+    self.assertEqual(
+        [poll.Transition(poll.FAILOVER_STARTED, 'G', 'eth0', 'active', 'inactive')],
+        self.tracker.Update(_status(('eth0', 'true', 'inactive'), ('eth1', 'true', 'failover'))))
+    self.assertEqual(
+        [poll.Transition(poll.FAILOVER_ENDED, 'G', 'eth0', 'inactive', 'active')],
+        self.tracker.Update(_status(('eth0', 'true', 'active'), ('eth1', 'true', 'failover'))))
+
+  def testOtherStatusChange(self):
+    # neither status is 'inactive': not a failover
+    self.assertEqual([], self.tracker.Update(
+        _status(('eth0', 'true', 'active'), ('eth1', 'true', 'active'))))
+
+  def testReachableFlipped(self):
+    transitions = self.tracker.Update(_status(('eth0', 'false', 'inactive'), ('eth1', 'true', 'failover')))
+    self.assertEqual([poll.FAILOVER_STARTED, poll.REACHABLE_FLIPPED], [t.kind for t in transitions])
+    flipped = transitions[1]
+    self.assertEqual(('G', 'eth0'), (flipped.group, flipped.interface))
+    self.assertNotEqual(flipped.old, flipped.new)
+
+  def testInterfacesComeAndGo(self):
+    self.assertEqual([], self.tracker.Update(_status(('eth0', 'true', 'active'))))
+    self.assertEqual([], self.tracker.Update(
+        _status(('eth0', 'true', 'active'), ('eth2', 'false', 'inactive'))))
+    # eth2 gone again; only eth0's change counts
+    transitions = self.tracker.Update(_status(('eth0', 'false', 'active')))
+    self.assertEqual([(poll.REACHABLE_FLIPPED, 'eth0')], [(t.kind, t.interface) for t in transitions])
+
+
+if __name__ == '__main__':
+  unittest.main()